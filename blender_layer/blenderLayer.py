@@ -1,7 +1,7 @@
-import sys, math, threading
+import sys, math, threading, socket
 from krita import *
 
-from PyQt5.QtCore import Qt, QThreadPool
+from PyQt5.QtCore import Qt, QThreadPool, QTimer, QRectF
 from os import path
 from functools import partial
 from types import SimpleNamespace
@@ -16,12 +16,18 @@ from PyQt5.QtWidgets import (
     QWidget,
     QSpinBox,
     QFrame,
-    QScrollArea
+    QScrollArea,
+    QMdiArea
 )
 from .navigateWidget import NavigateWidget
-from .blenderLayerServer import BlenderLayerServer, BlenderRunnable
+from .blenderLayerServer import BlenderLayerServer, BlenderRunnable, unixSocketPath
 
 instance = Krita.instance()
+# Frame rates Blender can aim for in live mode
+TARGET_FPS = [60, 30, 15, 5]
+# Milliseconds between checks of the visible part of the canvas
+FOLLOW_VIEW_INTERVAL = 200
+CANVAS_WIDGETS = ['KisOpenGLCanvas2', 'KisQPainterCanvas']
     
 class BlenderLayer(DockWidget):
 
@@ -34,9 +40,11 @@ class BlenderLayer(DockWidget):
         self.settings.transparency = True
         self.settings.gizmos = False
         self.settings.scale = 0
-        self.settings.framerateScale = 0
+        self.settings.targetFps = TARGET_FPS[1]
         self.settings.region = False
         self.settings.regionViewport = True
+        self.settings.followView = False
+        self.settings.canvasView = None
         self.settings.renderCurrentView = False
         self.settings.lensZoom = True
         self.settings.engine = ''
@@ -51,6 +59,9 @@ class BlenderLayer(DockWidget):
         self.activeInFile = None
         self.activeDocument = None
         self.blockServerSignal = False
+        self.followViewTimer = QTimer()
+        self.followViewTimer.setInterval(FOLLOW_VIEW_INTERVAL)
+        self.followViewTimer.timeout.connect(self.updateCanvasView)
         self.setWindowTitle(i18n("Blender Layer"))
 
         scrollContainer = QWidget()
@@ -251,15 +262,18 @@ class BlenderLayer(DockWidget):
         updateVBoxLayout = QVBoxLayout()
         
         updateForm = QFormLayout()
-        updateRateLabel = QLabel(i18n("Update")) 
+        updateRateLabel = QLabel(i18n("Frame rate")) 
         updateRateComboBox = QComboBox()
-        updateRateComboBox.addItems([i18n("Every frame"), i18n("Every 4th frame"), i18n("Every 16th frame"), i18n("Every 64th frame")])
+        updateRateComboBox.addItems([i18n("{0} FPS").format(fps) for fps in TARGET_FPS])
+        updateRateComboBox.setCurrentIndex(TARGET_FPS.index(self.settings.targetFps))
+        updateRateComboBox.setToolTip(i18n("Frame rate Blender aims for in live mode.\nBlender also waits for Krita to take the previous frames, so it may be lower"))
         
         updateResLabel = QLabel(i18n("Resolution")) 
         updateResComboBox = QComboBox()
-        updateResComboBox.addItems([i18n("Full"), i18n("Half"), i18n("Quarter"), i18n("Eighth")])
+        updateResComboBox.addItems([i18n("Full"), i18n("Half"), i18n("Quarter"), i18n("Eighth"), i18n("Adaptive")])
+        updateResComboBox.setItemData(4, i18n("Lower the resolution while navigating to stay within the frame budget,\nfull resolution once the view settles"), QtCore.Qt.ToolTipRole)
         
-        #updateForm.addRow(updateRateLabel, updateRateComboBox)
+        updateForm.addRow(updateRateLabel, updateRateComboBox)
         updateForm.addRow(updateResLabel, updateResComboBox)
 
         line3 = QFrame()
@@ -283,6 +297,8 @@ class BlenderLayer(DockWidget):
         regionCheck = QCheckBox(i18n("Limit image region"))
         regionCheck.setToolTip(i18n("Limit the frame to a sub-region of the image"))
         regionGroupBox = QGroupBox(i18n("Image Region"))
+        followViewCheck = QCheckBox(i18n("Follow canvas view"))
+        followViewCheck.setToolTip(i18n("Only render the part of the image visible in the canvas, at the resolution it is shown with.\nRecommended for large images"))
         regionGroupBox.hide()
         regionVBoxLayout = QVBoxLayout()
         
@@ -375,6 +391,7 @@ class BlenderLayer(DockWidget):
         vboxlayout.addWidget(updateGroupBox)
         vboxlayout.addWidget(regionCheck)
         vboxlayout.addWidget(regionGroupBox)
+        vboxlayout.addWidget(followViewCheck)
         vboxlayout.addWidget(libraryGroupBox)
         vboxlayout.addStretch(1)
         vboxlayout.addLayout(settingsHBoxLayout)
@@ -450,6 +467,7 @@ class BlenderLayer(DockWidget):
         updateComboBox.currentIndexChanged.connect(self.updateModeChanged)
         regionCheck.toggled.connect(regionGroupBox.setVisible)
         regionCheck.toggled.connect(self.resetRegion)
+        followViewCheck.toggled.connect(self.followViewChanged)
 
         navigateWidget.rotateSignal.connect(lambda p: self.sendBlockableMessage(('rotate', p.x(), p.y(), float(rollSpinBox.value() / 180 * math.pi))))
         navigateWidget.panSignal.connect(lambda p: self.sendBlockableMessage(('pan', p.x(), p.y())))
@@ -464,7 +482,7 @@ class BlenderLayer(DockWidget):
         transparentCheck.toggled.connect(partial(self.setSettingsAndSend, 'transparency'))
         gizmoCheck.toggled.connect(partial(self.setSettingsAndSend, 'gizmos'))
 
-        updateRateComboBox.currentIndexChanged.connect(partial(self.setSettingsAndSend, 'framerateScale'))
+        updateRateComboBox.currentIndexChanged.connect(lambda i: self.setSettingsAndSend('targetFps', TARGET_FPS[i]))
         updateResComboBox.currentIndexChanged.connect(partial(self.setSettingsAndSend, 'scale'))
 
         regionXSpinBox.valueChanged.connect(self.regionChanged)
@@ -702,10 +720,57 @@ class BlenderLayer(DockWidget):
         sharedMemCheckBox.setToolTip(i18n("Use shared memory to transfer the pixels from Blender.\nShould have better performance than sending them via the socket"))
         sharedMemCheckBox.toggled.connect(lambda v: setattr(self.settings, 'sharedMem', v))
 
+        unixSocketCheckBox = QCheckBox(i18n("Use Unix domain socket"))
+        unixSocketCheckBox.setChecked(self.settings.unixSocket)
+        unixSocketCheckBox.setEnabled(hasattr(socket, 'AF_UNIX'))
+        unixSocketCheckBox.setToolTip(i18n("Connect via a Unix domain socket instead of TCP.\nOnly works if Blender runs on the same machine, the host is ignored"))
+        unixSocketCheckBox.toggled.connect(lambda v: setattr(self.settings, 'unixSocket', v))
+
+        compressionCheckBox = QCheckBox(i18n("Compress frames"))
+        compressionCheckBox.setChecked(self.settings.compression)
+        compressionCheckBox.setToolTip(i18n("Allow Blender to compress frames sent via the socket.\nBlender only compresses when it measures that it's faster than sending the raw pixels"))
+        compressionCheckBox.toggled.connect(lambda v: setattr(self.settings, 'compression', v))
+
+        smoothUpscaleCheckBox = QCheckBox(i18n("Smooth upscaling"))
+        smoothUpscaleCheckBox.setChecked(self.settings.smoothUpscale)
+        smoothUpscaleCheckBox.setToolTip(i18n("Upscale frames rendered at reduced resolution bilinearly instead of repeating pixels.\nNot available for floating point documents before Qt 6.2, Blender upscales those by repeating pixels"))
+        smoothUpscaleCheckBox.toggled.connect(lambda v: setattr(self.settings, 'smoothUpscale', v))
+
+        frameBudgetSpinBox = QSpinBox()
+        frameBudgetSpinBox.setRange(5, 1000)
+        frameBudgetSpinBox.setSuffix(i18n(" ms"))
+        frameBudgetSpinBox.setValue(self.settings.frameBudget)
+        frameBudgetSpinBox.setToolTip(i18n("Time a frame may take with the adaptive resolution, from drawing in Blender until it is sent to Krita"))
+        frameBudgetSpinBox.valueChanged.connect(lambda v: setattr(self.settings, 'frameBudget', v))
+
+        progressiveCheckBox = QCheckBox(i18n("Progressive refinement"))
+        progressiveCheckBox.setChecked(self.settings.progressive)
+        progressiveCheckBox.setToolTip(i18n("While navigating the view from Krita, Blender sends quick low resolution frames.\nOnce the view stays still, it sends one frame at full quality"))
+        progressiveCheckBox.toggled.connect(lambda v: setattr(self.settings, 'progressive', v))
+
+        progressiveDelaySpinBox = QSpinBox()
+        progressiveDelaySpinBox.setRange(50, 5000)
+        progressiveDelaySpinBox.setSuffix(i18n(" ms"))
+        progressiveDelaySpinBox.setValue(self.settings.progressiveDelay)
+        progressiveDelaySpinBox.setToolTip(i18n("How long the view has to stay still before the full quality frame is rendered"))
+        progressiveDelaySpinBox.valueChanged.connect(lambda v: setattr(self.settings, 'progressiveDelay', v))
+
+        progressive8BitCheckBox = QCheckBox(i18n("8 bit previews"))
+        progressive8BitCheckBox.setChecked(self.settings.progressive8Bit)
+        progressive8BitCheckBox.setToolTip(i18n("Send the low resolution frames with 8 bits per channel for documents with a higher depth.\nThe full quality frame always has the depth of the document"))
+        progressive8BitCheckBox.toggled.connect(lambda v: setattr(self.settings, 'progressive8Bit', v))
+
         connectionForm = QFormLayout()
         connectionForm.addRow(i18n("Host:"), hostInput)
         connectionForm.addRow(i18n("Port:"), portSpinBox)
+        connectionForm.addRow(unixSocketCheckBox)
         connectionForm.addRow(sharedMemCheckBox)
+        connectionForm.addRow(compressionCheckBox)
+        connectionForm.addRow(smoothUpscaleCheckBox)
+        connectionForm.addRow(i18n("Adaptive frame budget:"), frameBudgetSpinBox)
+        connectionForm.addRow(progressiveCheckBox)
+        connectionForm.addRow(i18n("Refinement delay:"), progressiveDelaySpinBox)
+        connectionForm.addRow(progressive8BitCheckBox)
         connectionGroupBox.setLayout(connectionForm)
         
         assistantsGroupBox = QGroupBox(i18n("Assistants"))
@@ -856,7 +921,10 @@ class BlenderLayer(DockWidget):
             
         self.determineBlenderPath()   
         if self.settings.blenderPath:
-            args = [self.settings.blenderPath, '--python', str(path.abspath(os.path.join(os.path.dirname(__file__), 'blenderLayerClient.py'))), '--', '--connect-to-krita', str(self.settings.host), str(self.settings.port)]
+            host = str(self.settings.host)
+            if self.settings.unixSocket and hasattr(socket, 'AF_UNIX'):
+                host = 'unix:' + unixSocketPath(self.settings.port)
+            args = [self.settings.blenderPath, '--python', str(path.abspath(os.path.join(os.path.dirname(__file__), 'blenderLayerClient.py'))), '--', '--connect-to-krita', host, str(self.settings.port)]
             
             if self.activeInFile == None:
                 self.activeInFile = instance.activeDocument().fileName()
@@ -926,8 +994,8 @@ class BlenderLayer(DockWidget):
             self.startBlenderButton.setText(i18n("Connected")) 
             file = ''
             if info:
-                transparancySupported = info[1]
-                file = info[2]
+                transparancySupported = info.get('transparency', False)
+                file = info.get('file', '')
                 
                 self.transparentCheck.setEnabled(transparancySupported)
                 if not transparancySupported:
@@ -948,12 +1016,24 @@ class BlenderLayer(DockWidget):
         type = msg[0]
         if type == 'poselib':
             self.updatePoseLibrary(msg[1], msg[2])
+        elif type == 'poselibDiff':
+            self.updatePoseLibraryDiff(msg[1], msg[2])
         elif type == 'armatures':
             self.poseArmatures.clear()
             if len(msg[1]) == 0:
                 self.poseArmatures.addItems([i18n("<None>")])
             else:
                 self.poseArmatures.addItems(msg[1])
+        elif type == 'armaturesDiff':
+            if msg[1] and self.poseArmatures.count() == 1 and self.poseArmatures.itemText(0) == i18n("<None>"):
+                self.poseArmatures.clear()
+            for name in msg[2]:
+                i = self.poseArmatures.findText(name)
+                if i >= 0:
+                    self.poseArmatures.removeItem(i)
+            self.poseArmatures.addItems([name for name in msg[1] if self.poseArmatures.findText(name) < 0])
+            if self.poseArmatures.count() == 0:
+                self.poseArmatures.addItems([i18n("<None>")])
         elif type == 'posePreviews':
             for (name, pixels) in msg[1]:
                 self.loadPosePreview(name, pixels)
@@ -1104,8 +1184,7 @@ class BlenderLayer(DockWidget):
         file.write('</assistants></paintingassistant>')
         file.close()
                     
-    def updatePoseLibrary(self, items, clearPreviews):
-        visible = len(items) > 0
+    def setPoseLibraryVisible(self, visible):
         if not self.librarySeperator.isVisible() and visible:
             self.libraryForm.insertRow(1, self.librarySeperator)
             self.libraryForm.insertRow(2, self.poseArmaturesLabel, self.poseArmatures)
@@ -1118,6 +1197,10 @@ class BlenderLayer(DockWidget):
         self.poseArmaturesLabel.setVisible(visible)
         self.poseList.setVisible(visible)
 
+    def updatePoseLibrary(self, items, clearPreviews):
+        visible = len(items) > 0
+        self.setPoseLibraryVisible(visible)
+
         self.poseList.clear()
         self.settings.poseLib = items
         if clearPreviews:
@@ -1125,31 +1208,50 @@ class BlenderLayer(DockWidget):
             if self.server and self.server.running and visible:
                 self.server.sendMessage(('posePreviews', self.settings.poseLib[:10]))
         for name in items:
-            pixels = self.settings.posePreviews.get(name)
-            widget = QWidget()
-            layout = QVBoxLayout()
-            layout.setContentsMargins(0, 0, 0, 11)
-            image = QLabel()
-            image.setAlignment(Qt.AlignCenter)
-            if pixels:
-                image.setPixmap(QPixmap.fromImage(QImage(pixels, 128, 128, QImage.Format_RGBA8888)))
-                image.setMinimumWidth(128)
-            else:
-                icon = instance.icon('folder-pictures')
-                image.setPixmap(icon.pixmap(icon.actualSize(QSize(64, 64))))
-                image.setMinimumWidth(128)
-            text = QLabel(name)
-            text.setAlignment(Qt.AlignCenter)
-            layout.addStretch()
-            layout.addWidget(image)
-            layout.addStretch()
-            layout.addWidget(text)
-            #layout.setSizeConstraint(QLayout.SetFixedSize)
-            widget.setLayout(layout)
-            item = QListWidgetItem()
-            item.setSizeHint(widget.sizeHint())    
-            self.poseList.addItem(item)
-            self.poseList.setItemWidget(item, widget)
+            self.addPoseItem(name)
+
+    def updatePoseLibraryDiff(self, added, removed):
+        # Blender only sends what changed since the last list, the remaining items keep their widgets and previews
+        for name in removed:
+            if name in self.settings.poseLib:
+                i = self.settings.poseLib.index(name)
+                self.poseList.takeItem(i)
+                del self.settings.poseLib[i]
+                self.settings.posePreviews.pop(name, None)
+        for name in added:
+            if name not in self.settings.poseLib:
+                self.settings.poseLib.append(name)
+                self.addPoseItem(name)
+        self.setPoseLibraryVisible(len(self.settings.poseLib) > 0)
+        if added and self.server and self.server.running:
+            self.requestPosePreviews(0)
+
+    def addPoseItem(self, name):
+        pixels = self.settings.posePreviews.get(name)
+        widget = QWidget()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 11)
+        image = QLabel()
+        image.setAlignment(Qt.AlignCenter)
+        if pixels:
+            image.setPixmap(QPixmap.fromImage(QImage(pixels, 128, 128, QImage.Format_RGBA8888)))
+            image.setMinimumWidth(128)
+        else:
+            icon = instance.icon('folder-pictures')
+            image.setPixmap(icon.pixmap(icon.actualSize(QSize(64, 64))))
+            image.setMinimumWidth(128)
+        text = QLabel(name)
+        text.setAlignment(Qt.AlignCenter)
+        layout.addStretch()
+        layout.addWidget(image)
+        layout.addStretch()
+        layout.addWidget(text)
+        #layout.setSizeConstraint(QLayout.SetFixedSize)
+        widget.setLayout(layout)
+        item = QListWidgetItem()
+        item.setSizeHint(widget.sizeHint())    
+        self.poseList.addItem(item)
+        self.poseList.setItemWidget(item, widget)
             
     def loadPosePreview(self, name, pixels):
         if pixels:
@@ -1409,6 +1511,47 @@ class BlenderLayer(DockWidget):
         if self.server and self.server.running:
             self.server.sendMessage(('region', self.settings.regionX, self.settings.regionY, self.settings.regionWidth, self.settings.regionHeight, self.settings.regionViewport))
             
+    def followViewChanged(self, b):
+        self.settings.followView = b
+        if b:
+            self.followViewTimer.start()
+            self.updateCanvasView()
+        else:
+            self.followViewTimer.stop()
+            self.settings.canvasView = None
+            if self.server and self.server.running:
+                self.server.sendMessage(('canvasView', None))
+
+    def updateCanvasView(self):
+        view = self.visibleCanvasRect()
+        if view != self.settings.canvasView:
+            self.settings.canvasView = view
+            if self.server and self.server.running:
+                self.server.sendMessage(('canvasView', view))
+
+    def visibleCanvasRect(self):
+        # Part of the image shown in the active canvas and how many screen pixels an image pixel covers
+        window = instance.activeWindow()
+        view = window.activeView() if window else None
+        d = self.activeDocument if self.activeDocument else instance.activeDocument()
+        if not view or not d or not hasattr(view, 'flakeToImageTransform') or view.document() != d:
+            return self.settings.canvasView
+        mdiArea = window.qwindow().findChild(QMdiArea)
+        subWindow = mdiArea.activeSubWindow() if mdiArea else None
+        canvas = next((w for w in subWindow.widget().findChildren(QWidget) if w.metaObject().className() in CANVAS_WIDGETS), None) if subWindow and subWindow.widget() else None
+        if not canvas:
+            return self.settings.canvasView
+        canvasToImage = view.flakeToCanvasTransform().inverted()[0] * view.flakeToImageTransform()
+        rect = canvasToImage.mapRect(QRectF(0, 0, canvas.width(), canvas.height()))
+        x = max(math.floor(rect.left()), 0)
+        y = max(math.floor(rect.top()), 0)
+        w = min(math.ceil(rect.right()), d.width()) - x
+        h = min(math.ceil(rect.bottom()), d.height()) - y
+        if w <= 0 or h <= 0:
+            return self.settings.canvasView
+        zoom = canvas.devicePixelRatioF() / math.hypot(canvasToImage.m11(), canvasToImage.m12())
+        return (x, y, w, h, round(zoom, 3))
+            
     def updateCyclesWarning(self, engine, shading):
         self.settings.engine = engine
         self.settings.shading = shading
@@ -1475,7 +1618,15 @@ class BlenderLayer(DockWidget):
         
         self.settings.host = instance.readSetting('blender_layer', 'host', '127.0.0.1')
         portStr = instance.readSetting('blender_layer', 'port', '')
+        self.settings.unixSocket = instance.readSetting('blender_layer', 'unixSocket', 'False') == 'True'
         self.settings.sharedMem = instance.readSetting('blender_layer', 'sharedMem', 'True') == 'True'
+        self.settings.compression = instance.readSetting('blender_layer', 'compression', 'True') == 'True'
+        self.settings.smoothUpscale = instance.readSetting('blender_layer', 'smoothUpscale', 'False') == 'True'
+        frameBudgetStr = instance.readSetting('blender_layer', 'frameBudget', '')
+        targetFpsStr = instance.readSetting('blender_layer', 'targetFps', '')
+        self.settings.progressive = instance.readSetting('blender_layer', 'progressive', 'False') == 'True'
+        progressiveDelayStr = instance.readSetting('blender_layer', 'progressiveDelay', '')
+        self.settings.progressive8Bit = instance.readSetting('blender_layer', 'progressive8Bit', 'True') == 'True'
 
         self.settings.assistantsThreePoint = instance.readSetting('blender_layer', 'assistantsThreePoint', 'True') == 'True'
         self.settings.assistantsAxis = instance.readSetting('blender_layer', 'assistantsAxis', 'True') == 'True'
@@ -1491,6 +1642,23 @@ class BlenderLayer(DockWidget):
             self.settings.port = int(portStr)
         except ValueError:
             self.settings.port = 65432
+
+        try:
+            self.settings.frameBudget = int(frameBudgetStr)
+        except ValueError:
+            self.settings.frameBudget = 33
+
+        try:
+            self.settings.targetFps = int(targetFpsStr)
+        except ValueError:
+            self.settings.targetFps = TARGET_FPS[1]
+        if self.settings.targetFps not in TARGET_FPS:
+            self.settings.targetFps = TARGET_FPS[1]
+
+        try:
+            self.settings.progressiveDelay = int(progressiveDelayStr)
+        except ValueError:
+            self.settings.progressiveDelay = 300
             
         try:
             lib = []
@@ -1515,7 +1683,15 @@ class BlenderLayer(DockWidget):
         instance.writeSetting('blender_layer', 'library', '////'.join([name + '\\\\' + file + '\\\\' + innerpath for (name, file, innerpath) in self.settings.library]))
         instance.writeSetting('blender_layer', 'host', self.settings.host)
         instance.writeSetting('blender_layer', 'port', str(self.settings.port))
+        instance.writeSetting('blender_layer', 'unixSocket', str(self.settings.unixSocket))
         instance.writeSetting('blender_layer', 'sharedMem', str(self.settings.sharedMem))
+        instance.writeSetting('blender_layer', 'compression', str(self.settings.compression))
+        instance.writeSetting('blender_layer', 'smoothUpscale', str(self.settings.smoothUpscale))
+        instance.writeSetting('blender_layer', 'frameBudget', str(self.settings.frameBudget))
+        instance.writeSetting('blender_layer', 'targetFps', str(self.settings.targetFps))
+        instance.writeSetting('blender_layer', 'progressive', str(self.settings.progressive))
+        instance.writeSetting('blender_layer', 'progressiveDelay', str(self.settings.progressiveDelay))
+        instance.writeSetting('blender_layer', 'progressive8Bit', str(self.settings.progressive8Bit))
         instance.writeSetting('blender_layer', 'assistantsThreePoint', str(self.settings.assistantsThreePoint))
         instance.writeSetting('blender_layer', 'assistantsAxis', str(self.settings.assistantsAxis))
         instance.writeSetting('blender_layer', 'overrideSRGB', str(self.settings.overrideSRGB))
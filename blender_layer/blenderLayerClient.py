@@ -4,9 +4,18 @@ import mathutils
 import atexit
 import os
 from gpu_extras.presets import draw_texture_2d
-import socket, sys, struct, pickle
-from multiprocessing import shared_memory, SimpleQueue
+import socket, sys, struct, pickle, zlib
+from multiprocessing import shared_memory
+from collections import deque, OrderedDict
 from bpy.app.handlers import persistent
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 bl_info = {
     'name': "Connect to Krita (Blender Layer)",
@@ -29,17 +38,173 @@ try:
 except ValueError:
     pass
     
+# Raised for changes an older peer can't ignore, each side refuses a peer with a newer version than its own.
+# Additions both sides can negotiate go into the capabilities instead, unknown fields and capabilities are ignored
+PROTOCOL_VERSION = 1
+# Optional protocol features this side understands
+FEATURES = ['updateTile', 'updateTrimmed', 'scaledFrames', 'rgba8Frames', 'frameAcks']
+
+PACKET_OBJECT = 0
+PACKET_FRAME = 1
+FRAME_TYPES = ['update', 'updateFrame', 'updateTile', 'updateTrimmed']
+TILE_SIZE = 64
+FORMATS = ['RGBA8', 'RGBA16', 'RGBA16F', 'RGBA32F']
+DTYPES = {'RGBA8': np.uint8, 'RGBA16': np.uint16, 'RGBA16F': np.float16, 'RGBA32F': np.float32}
+CODECS = ['raw', 'rle', 'zlib', 'lz4']
+# Shorter runs of transparent pixels stay literal, each run costs 8 bytes
+RLE_MIN_RUN = 16
+CODEC_DECAY = 0.8
+CODEC_EXPLORE_INTERVAL = 60
+# Messages describing the view, only their latest value per batch matters
+COALESCED_MESSAGES = {'rotate', 'lens', 'ortho', 'shading'}
+# Krita's view messages, only the latest state (or for zoom and pan the sum) of those waiting for an update is applied
+RECEIVED_COALESCED_MESSAGES = {'rotate', 'lens', 'ortho', 'shading', 'region', 'canvasView', 'scale', 'viewMode', 'zoom', 'pan'}
+# Resolution index Krita sends for the adaptive resolution
+ADAPTIVE_SCALE = 4
+ADAPTIVE_SCALES = [1, 2, 4, 8]
+# Seconds without navigation before the adaptive resolution returns to full
+ADAPTIVE_SETTLE_DELAY = 0.3
+ADAPTIVE_DECAY = 0.7
+# Resolution divisor for the quick frames of the progressive refinement
+PROGRESSIVE_SCALE = 4
+# Largest offscreen when the GPU can't tell its maximum texture size, larger frames are rendered in tiles
+MAX_RENDER_SIZE = 4096
+# Largest offscreen in bytes including its depth buffer, larger frames are rendered in tiles even if the GPU could take them at once
+MAX_RENDER_BYTES = 256 * 1024 * 1024
+# Bytes of offscreens kept around for sizes, formats and shadings used recently
+OFFSCREEN_POOL_SIZE = 512 * 1024 * 1024
+# Frame shapes the converter keeps arrays for
+CONVERTER_POOL_SHAPES = 3
+# Converted frames that may wait for the sending thread, more would only add latency
+PIPELINE_DEPTH = 1
+# Seconds live mode keeps rendering after a change in shadings that refine over several samples
+LIVE_REFINE_TIME = 2.0
+# Frames live mode may send ahead of Krita's acknowledgements
+FRAME_CREDITS = 2
+# Seconds without messages before an empty batch is sent, so Krita knows the connection is alive
+KEEPALIVE_INTERVAL = 1.0
+
+# kind, payload length
+packetHeader = struct.Struct('>BI')
+# type, x, y, width, height, format, sequence, frame (-1 for none), codec, scale (pixels are width / scale by height / scale)
+frameHeader = struct.Struct('>B4iBIiBB')
+# number of (literal pixels, zero pixels) runs following
+rleHeader = struct.Struct('<I')
+
+RING_HEADER_SIZE = 64
+RING_READING_OFFSET = 16
+SLOT_HEADER_SIZE = 64
+# slot count, slot data size
+ringHeader = struct.Struct('<IQ')
+# slot currently read by Krita (-1 for none)
+ringReading = struct.Struct('<i')
+# seqlock counter, odd while Blender is writing
+slotLock = struct.Struct('<Q')
+# frame sequence, bytes written
+slotInfo = struct.Struct('<IQ')
+
 def sendObj(conn, obj):
     msg = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
-    msg = struct.pack('>I', len(msg)) + msg
+    msg = packetHeader.pack(PACKET_OBJECT, len(msg)) + msg
     conn.sendall(msg)
+
+def sendFrame(conn, type, x, y, w, h, format, sequence, frame, scale, codec, bodies):
+    size = sum(memoryview(body).nbytes for body in bodies)
+    header = packetHeader.pack(PACKET_FRAME, frameHeader.size + size) + frameHeader.pack(FRAME_TYPES.index(type), x, y, w, h, FORMATS.index(format), sequence, -1 if frame is None else frame, CODECS.index(codec), scale)
+    sendParts(conn, [header] + bodies)
+    return size
+
+def encodeFrame(codec, pixels):
+    raw = memoryview(pixels.reshape(-1).view(np.uint8))
+    if codec == 'zlib':
+        bodies = [zlib.compress(raw, 1)]
+    elif codec == 'lz4':
+        bodies = [lz4block.compress(raw, store_size = False)]
+    elif codec == 'rle':
+        bodies = encodeRLE(pixels)
+    else:
+        return 'raw', [raw]
+    if sum(memoryview(body).nbytes for body in bodies) >= raw.nbytes:
+        return 'raw', [raw]
+    return codec, bodies
+
+def encodeRLE(pixels):
+    n = pixels.shape[0] * pixels.shape[1]
+    if n == 0:
+        return [rleHeader.pack(0)]
+    flat = pixels.reshape(-1).view(np.uint8).reshape(n, -1)
+    zero = ~flat.any(axis = 1)
+    edges = np.flatnonzero(zero[1:] != zero[:-1]) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [n]))
+    keep = zero[starts] & (ends - starts >= RLE_MIN_RUN)
+    zeroStarts = starts[keep]
+    zeroEnds = ends[keep]
+    runs = np.empty((len(zeroStarts) + 1, 2), dtype = '<u4')
+    runs[:, 0] = np.concatenate((zeroStarts, [n])) - np.concatenate(([0], zeroEnds))
+    runs[:, 1] = np.concatenate((zeroEnds - zeroStarts, [0]))
+    inRun = np.zeros(n + 1, dtype = np.int32)
+    inRun[zeroStarts] = 1
+    inRun[zeroEnds] -= 1
+    literals = flat[np.cumsum(inRun[:-1]) == 0]
+    return [rleHeader.pack(len(runs)), runs.reshape(-1).view(np.uint8), literals.reshape(-1)]
+
+class CodecSelector():
+    # Picks the codec with the lowest measured cost per raw byte, encoding plus sending the result
+    def __init__(self, codecs):
+        self.codecs = codecs
+        self.stats = {}
+        self.sentBytes = 0.0
+        self.sentTime = 0.0
+        self.choices = 0
+        self.lastUsed = {codec: 0 for codec in codecs}
+
+    def choose(self):
+        self.choices = self.choices + 1
+        for codec in self.codecs:
+            if codec not in self.stats:
+                return codec
+        if len(self.codecs) > 1 and self.choices % CODEC_EXPLORE_INTERVAL == 0:
+            # Conditions change, occasionally measure the one that wasn't used for the longest time
+            return min(self.codecs, key = lambda codec: self.lastUsed[codec])
+        return min(self.codecs, key = self.cost)
+
+    def cost(self, codec):
+        rawBytes, encodedBytes, encodeTime = self.stats[codec]
+        if rawBytes <= 0:
+            return 0.0
+        sendTime = encodedBytes * self.sentTime / self.sentBytes if self.sentBytes > 0 else 0.0
+        return (encodeTime + sendTime) / rawBytes
+
+    def record(self, codec, rawBytes, encodedBytes, encodeTime, sendTime):
+        r, e, t = self.stats.get(codec, (0.0, 0.0, 0.0))
+        self.stats[codec] = (r * CODEC_DECAY + rawBytes, e * CODEC_DECAY + encodedBytes, t * CODEC_DECAY + encodeTime)
+        self.sentBytes = self.sentBytes * CODEC_DECAY + encodedBytes
+        self.sentTime = self.sentTime * CODEC_DECAY + sendTime
+        self.lastUsed[codec] = self.choices
+
+def sendParts(conn, parts):
+    if not hasattr(conn, 'sendmsg'):
+        for part in parts:
+            conn.sendall(part)
+        return
+    views = [memoryview(part) for part in parts]
+    while views:
+        sent = conn.sendmsg(views)
+        while views and sent >= views[0].nbytes:
+            sent = sent - views[0].nbytes
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
         
 def recvObj(conn):
-    raw_msglen = recvAll(conn, 4)
-    if not raw_msglen:
+    raw_header = recvAll(conn, packetHeader.size)
+    if not raw_header:
         return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
+    kind, msglen = packetHeader.unpack(raw_header)
     msg = recvAll(conn, msglen)
+    if kind != PACKET_OBJECT:
+        raise RuntimeError("Protocol error: Expected object packet")
     return pickle.loads(msg) 
 
 def recvAll(conn, n):
@@ -51,6 +216,352 @@ def recvAll(conn, n):
         data.extend(packet)
     return data
     
+class MessageBus():
+    # Hands messages between threads of this process as they are, without pickling them through a pipe
+    def __init__(self, merges = {}, priorities = {}, coalesce = set()):
+        # merges maps a type to how two consecutive messages of it combine (None keeps both), the None key applies to all other types
+        self.merges = merges
+        self.priorities = priorities
+        # Types in coalesce are merged across the whole batch, not only when consecutive
+        self.coalesce = coalesce
+        self.condition = threading.Condition()
+        self.messages = []
+        self.woken = False
+
+    def put(self, msg):
+        with self.condition:
+            self.messages.append(msg)
+            self.condition.notify_all()
+
+    def empty(self):
+        return not self.messages
+
+    def get(self):
+        with self.condition:
+            return self.messages.pop(0)
+
+    def clear(self):
+        with self.condition:
+            self.messages = []
+
+    def putBack(self, msgs):
+        # Drained messages that weren't handled yet, they stay ahead of anything queued since
+        with self.condition:
+            self.messages = msgs + self.messages
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def wait(self, timeout = None):
+        with self.condition:
+            if not self.messages and not self.woken:
+                self.condition.wait(timeout)
+            self.woken = False
+            return len(self.messages) > 0
+
+    def drain(self):
+        with self.condition:
+            messages = self.messages
+            self.messages = []
+        msgs = []
+        for msg in messages:
+            merge = self.merges.get(msg[0], self.merges.get(None))
+            if msgs and msgs[-1][0] == msg[0] and merge:
+                msgs[-1] = merge(msgs[-1], msg)
+            else:
+                msgs.append(msg)
+        if self.coalesce:
+            last = {}
+            for i, msg in enumerate(msgs):
+                if msg[0] in self.coalesce:
+                    if msg[0] in last:
+                        # The combined message takes the later position
+                        merge = self.merges.get(msg[0], self.merges.get(None)) or latestMessage
+                        msgs[i] = merge(msgs[last[msg[0]]], msg)
+                        msgs[last[msg[0]]] = None
+                    last[msg[0]] = i
+            msgs = [msg for msg in msgs if msg is not None]
+        msgs.sort(key = lambda msg: -self.priorities.get(msg[0], 0))
+        return msgs
+
+def latestMessage(old, new):
+    return new
+
+def sumZoom(old, new):
+    return (new[0], old[1] + new[1])
+
+def sumPan(old, new):
+    return (new[0], old[1] + new[1], old[2] + new[2])
+
+def joinPosePreviews(old, new):
+    return (new[0], new[1] + old[1])
+
+class SharedFrameRing():
+    def __init__(self, name, generation = 0):
+        self.generation = generation
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.slots, self.dataSize = ringHeader.unpack_from(self.shm.buf, 0)
+        self.latest = -1
+
+    def slotOffset(self, slot):
+        return RING_HEADER_SIZE + slot * (SLOT_HEADER_SIZE + self.dataSize)
+
+    def write(self, sequence, parts):
+        bodies = [memoryview(pixels.reshape(-1).view(np.uint8)) for pixels in parts]
+        size = sum(body.nbytes for body in bodies)
+        if size > self.dataSize:
+            return None, None
+        # Never touch the slot Krita is reading, nor the newest complete one it may read next
+        reading = ringReading.unpack_from(self.shm.buf, RING_READING_OFFSET)[0]
+        for i in range(1, self.slots + 1):
+            slot = (self.latest + i) % self.slots
+            if slot != reading and slot != self.latest:
+                break
+        else:
+            return None, None
+        offset = self.slotOffset(slot)
+        lock = slotLock.unpack_from(self.shm.buf, offset)[0] & ~1
+        slotLock.pack_into(self.shm.buf, offset, lock + 1)
+        # The new sequence goes in first, so Krita can tell a frame that was overwritten from one that was torn
+        slotInfo.pack_into(self.shm.buf, offset + slotLock.size, sequence, size)
+        offsets = []
+        pos = offset + SLOT_HEADER_SIZE
+        for body in bodies:
+            offsets.append(pos - offset - SLOT_HEADER_SIZE)
+            self.shm.buf[pos:pos + body.nbytes] = body
+            pos = pos + body.nbytes
+        slotLock.pack_into(self.shm.buf, offset, lock + 2)
+        self.latest = slot
+        return slot, offsets
+
+    def close(self):
+        self.shm.close()
+
+def changedRects(cur, prev, tileSize):
+    h, w = cur.shape[:2]
+    changed = (cur != prev).any(axis=2)
+    tiles = np.logical_or.reduceat(np.logical_or.reduceat(changed, np.arange(0, h, tileSize), axis=0), np.arange(0, w, tileSize), axis=1)
+    rects = []
+    above = {}
+    for ty, row in enumerate(tiles):
+        cols = np.flatnonzero(row)
+        if len(cols) == 0:
+            above = {}
+            continue
+        # Merge runs of changed tiles into rows, and rows with the same span into rects
+        breaks = np.flatnonzero(np.diff(cols) > 1)
+        starts = cols[np.r_[0, breaks + 1]]
+        ends = cols[np.r_[breaks, len(cols) - 1]] + 1
+        y0 = ty * tileSize
+        y1 = min(y0 + tileSize, h)
+        current = {}
+        for start, end in zip(starts, ends):
+            x0 = int(start) * tileSize
+            x1 = min(int(end) * tileSize, w)
+            i = above.get((x0, x1))
+            if i is not None:
+                rx, ry, rw, rh = rects[i]
+                rects[i] = (rx, ry, rw, y1 - ry)
+            else:
+                i = len(rects)
+                rects.append((x0, y0, x1 - x0, y1 - y0))
+            current[(x0, x1)] = i
+        above = current
+    return rects
+
+def frameDigest(pixels):
+    data = memoryview(np.ascontiguousarray(pixels).reshape(-1).view(np.uint8))
+    if xxhash:
+        return xxhash.xxh3_64_intdigest(data)
+    # Both checksums run in C over the whole frame, together they make collisions unlikely enough
+    return (zlib.crc32(data), zlib.adler32(data))
+
+def rectsOverlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+def propertySnapshot(struct):
+    # The plain properties of a struct, viewport shading and overlay options change without a depsgraph update
+    values = []
+    for prop in struct.bl_rna.properties:
+        if prop.type in ('POINTER', 'COLLECTION'):
+            continue
+        value = getattr(struct, prop.identifier, None)
+        if isinstance(value, set):
+            value = frozenset(value)
+        elif getattr(prop, 'is_array', False):
+            value = tuple(value)
+        values.append(value)
+    return tuple(values)
+
+def alphaBox(pixels):
+    alpha = pixels[:, :, 3] != 0
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if len(rows) == 0:
+        return (0, 0, 0, 0)
+    cols = np.flatnonzero(alpha.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1)
+
+class FrameConverter():
+    # Flips and swizzles readbacks into a rotating set of preallocated arrays, frames that are still queued, sent or compared against stay intact
+    def __init__(self, count = 2):
+        self.count = count
+        # Arrays per shape and dtype, so switching back to a recent resolution or format doesn't allocate
+        self.pools = OrderedDict()
+
+    def convert(self, buf, h, w, dtype, bgr):
+        try:
+            # gpu.types.Buffer lists its dimensions first-fastest, unravelling them in that order is the readback memory itself
+            src = np.asarray(memoryview(buf)).ravel(order = 'F').reshape(h, w, 4)
+        except (TypeError, ValueError):
+            # Blender versions without the buffer protocol go through the sequence protocol
+            src = np.asarray(buf, dtype = dtype).ravel(order = 'F').reshape(h, w, 4)
+        key = (h, w, np.dtype(dtype))
+        pool = self.pools.pop(key, None)
+        if pool is None:
+            pool = [[np.empty((h, w, 4), dtype = dtype) for i in range(self.count)], 0]
+        self.pools[key] = pool
+        while len(self.pools) > CONVERTER_POOL_SHAPES:
+            self.pools.popitem(last = False)
+        # The array after the last committed one, a frame that is dropped leaves it free for the next
+        out = pool[0][(pool[1] + 1) % self.count]
+        src = src[::-1]
+        if bgr:
+            for channel, source in enumerate([2, 1, 0, 3]):
+                out[:, :, channel] = src[:, :, source]
+        else:
+            out[...] = src
+        return out
+
+    def commit(self, out):
+        # The frame converted into out enters the pipeline, only now may the rotation move past it
+        pool = self.pools.get(out.shape[:2] + (out.dtype,))
+        if pool is not None:
+            pool[1] = (pool[1] + 1) % self.count
+
+class OffscreenPool():
+    # Keeps recently used offscreens, so switching back to a size, format or shading doesn't allocate on the GPU again
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.offscreens = OrderedDict()
+
+    def get(self, width, height, format, shading, engine):
+        key = (width, height, format, shading, engine)
+        offscreen = self.offscreens.pop(key, None)
+        if offscreen is None:
+            offscreen = gpu.types.GPUOffScreen(width, height, format=format)
+        self.offscreens[key] = offscreen
+        # The least recently used ones go first, the one in use always stays
+        while len(self.offscreens) > 1 and sum(self.size(k) for k in self.offscreens) > self.maxBytes:
+            key, old = self.offscreens.popitem(last = False)
+            old.free()
+        return offscreen
+
+    def size(self, key):
+        width, height, format = key[:3]
+        # Color and depth attachments
+        return width * height * (np.dtype(DTYPES[format]).itemsize * 4 + 4)
+
+    def clear(self):
+        for offscreen in self.offscreens.values():
+            offscreen.free()
+        self.offscreens.clear()
+
+class PoseLibIndex():
+    # Armatures deforming meshes and actions marked as assets, kept up to date from depsgraph updates instead of walking every object
+    def __init__(self):
+        self.meshArmatures = {}
+        self.actions = {}
+
+    def rescan(self):
+        self.meshArmatures = {}
+        for obj in bpy.data.objects:
+            self.indexObject(obj)
+        self.actions = {action.name: None for action in bpy.data.actions if action.asset_data}
+
+    def indexObject(self, obj):
+        # Returns whether the armatures of the object changed
+        armatures = tuple(m.object.name for m in obj.modifiers if m.type == 'ARMATURE' and m.object) if obj.type == 'MESH' else ()
+        if armatures == self.meshArmatures.get(obj.name, ()):
+            return False
+        if armatures:
+            self.meshArmatures[obj.name] = armatures
+        else:
+            del self.meshArmatures[obj.name]
+        return True
+
+    def indexAction(self, action):
+        # Returns whether the action joined or left the library
+        if bool(action.asset_data) == (action.name in self.actions):
+            return False
+        if action.asset_data:
+            self.actions[action.name] = None
+        else:
+            del self.actions[action.name]
+        return True
+
+    def update(self, depsGraph, idsChanged):
+        # Returns whether anything indexed changed, posing and most edits don't touch the index
+        changed = False
+        for update in depsGraph.updates:
+            id = update.id.original if update.id else None
+            if isinstance(id, bpy.types.Object):
+                changed = self.indexObject(id) or changed
+            elif isinstance(id, bpy.types.Action):
+                changed = self.indexAction(id) or changed
+        if idsChanged:
+            # Removed data never shows up in the updates, only what is already indexed has to be checked
+            for name in list(self.meshArmatures):
+                obj = bpy.data.objects.get(name)
+                if obj:
+                    changed = self.indexObject(obj) or changed
+                else:
+                    del self.meshArmatures[name]
+                    changed = True
+            for name in list(self.actions):
+                action = bpy.data.actions.get(name)
+                if not action or not action.asset_data:
+                    del self.actions[name]
+                    changed = True
+        return changed
+
+    def armatures(self):
+        return list({name: None for names in self.meshArmatures.values() for name in names})
+
+    def poseLib(self):
+        return list(self.actions)
+
+class ResolutionScaler():
+    # Steps the render scale so frames fit the budget while navigating, and back to full resolution once the view settles
+    def __init__(self):
+        self.costPerPixel = None
+        self.lastNavigation = 0.0
+
+    def navigate(self):
+        self.lastNavigation = time.perf_counter()
+
+    def settled(self):
+        return time.perf_counter() - self.lastNavigation > ADAPTIVE_SETTLE_DELAY
+
+    def record(self, seconds, pixels):
+        if pixels <= 0:
+            return
+        cost = seconds / pixels
+        self.costPerPixel = cost if self.costPerPixel is None else self.costPerPixel * ADAPTIVE_DECAY + cost * (1 - ADAPTIVE_DECAY)
+
+    def choose(self, scale, width, height, budget):
+        if self.settled() or self.costPerPixel is None:
+            return 1
+        predict = lambda scale: self.costPerPixel * (width // scale) * (height // scale)
+        index = ADAPTIVE_SCALES.index(scale)
+        if predict(scale) > budget and index + 1 < len(ADAPTIVE_SCALES):
+            return ADAPTIVE_SCALES[index + 1]
+        # Some headroom before stepping up, so the scale doesn't flip every frame
+        if index > 0 and predict(ADAPTIVE_SCALES[index - 1]) < budget * 0.75:
+            return ADAPTIVE_SCALES[index - 1]
+        return scale
+
 def showMessageBox(message = "", title = "Blender Layer", icon = 'INFO'):
     def draw(self, context):
         self.layout.label(text=message)
@@ -60,25 +571,57 @@ class BlenderLayerClient():
     def __init__(self):
         self.connected = False
         self.thread = None
+        self.convertThread = None
+        self.recvThread = None
+        self.features = set()
+        # One array for the frame being converted, the queued ones and the one being sent
+        self.converter = FrameConverter(PIPELINE_DEPTH + 2)
+        self.offscreens = OffscreenPool(OFFSCREEN_POOL_SIZE)
+        self.scaler = ResolutionScaler()
+        self.adaptiveScale = False
+        self.scale = 1
+        self.viewScale = 1
+        self.canvasView = None
+        self.bufScale = 1
+        self.bufFormat = None
+        # The region the buffer was drawn for, following the canvas view may move it before the frame is converted
+        self.bufRegion = None
+        self.previewing = False
+        self.lastNavigation = 0.0
+        self.drawTime = 0.0
         self.s = None
-        self.shm = None
+        self.ring = None
         self.buf = []
         self.offscreen = None
 
     def connect(self, host, port):
         HOST = host
         PORT = port
-        MAGIC = b'BLENDER_LAYER_V1'
+        MAGIC = b'BLENDER_LAYER_V3'
         
         self.disconnect()
            
-        self.recvQueue = SimpleQueue()    
-        self.sendQueue = SimpleQueue()
+        self.recvQueue = MessageBus({'zoom': sumZoom, 'pan': sumPan}, {}, RECEIVED_COALESCED_MESSAGES)
+        # Thumbnails are the bulkiest messages, they can wait for the rest
+        # Each diff builds on the one before, so none of them may be merged away
+        self.sendQueue = MessageBus({'posePreviews': joinPosePreviews, 'poselibDiff': None, 'armaturesDiff': None, None: latestMessage}, {'posePreviews': -1}, COALESCED_MESSAGES)
         self.buf = []
         self.updateFlag = False
         self.requestFrame = True
         self.requestDelayedFrame = False
-        self.frame = -1
+        self.nextFrameTime = 0.0
+        self.liveFramePending = False
+        self.depsgraphGeneration = 0
+        self.liveKey = None
+        self.liveChanged = 0.0
+        self.tileQueue = deque()
+        # Tiles of the current frame still to be drawn, one is drawn whenever the converter took the previous one
+        self.pendingTiles = deque()
+        self.tileOffscreenKey = None
+        self.tilesWaiting = False
+        self.readbackReady = threading.Event()
+        self.converted = deque()
+        self.pipelineSlots = threading.Semaphore(PIPELINE_DEPTH)
         self.transparency_support = bpy.app.version >=(3, 6, 0)
         self.prevNumIds = None
         self.prevRot = None
@@ -88,6 +631,7 @@ class BlenderLayerClient():
         self.prevEngine = None
         self.prevPoseLib = None
         self.prevArmatures = None
+        self.poseIndex = PoseLibIndex()
         self.active_space = None
         self.active_region = None
         self.offscreen = None
@@ -96,13 +640,26 @@ class BlenderLayerClient():
         self.animFrame = 0
         self.ticksWaitingForFrame = 0
         self.requestDisconnect = False
+        self.frameSequence = 0
+        self.ackedSequence = 0
+        self.pendingRing = None
+        self.prevFrame = None
+        self.prevFrameKey = None
+        self.deliveredDigests = {}
+        self.keyframeRequested = True
 
-        print(f"[Blender Layer] Connecting to krita on port {PORT}...")
         try:
             self.connected = True
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.s.settimeout(5.0)
-            self.s.connect((HOST, PORT))
+            if HOST.startswith('unix:'):
+                print(f"[Blender Layer] Connecting to krita on {HOST[5:]}...")
+                self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.s.settimeout(5.0)
+                self.s.connect(HOST[5:])
+            else:
+                print(f"[Blender Layer] Connecting to krita on port {PORT}...")
+                self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.s.settimeout(5.0)
+                self.s.connect((HOST, PORT))
 
             self.s.sendall(MAGIC)
             check = self.s.recv(len(MAGIC))
@@ -110,30 +667,66 @@ class BlenderLayerClient():
                 print("[Blender Layer] Protocol error: Expected " + MAGIC.decode('ASCII') + " not " + check.decode('ASCII'))
                 raise RuntimeError("Protocol error")
                 
-            type, self.width, self.height, self.regionX, self.regionY, self.regionWidth, self.regionHeight, self.regionViewport, scale, framerateScale, self.formatDepth, self.bytesPerPixel, self.colorManagement, self.bgrConversion, self.transparency, self.gizmos, self.lensZoom, self.viewMode, self.updateMode, self.renderCurrentView, self.sharedMem, self.backgroundDraw = recvObj(self.s)
-            self.scale = 2 ** scale
-            self.framerateScale = 4 ** framerateScale
-            self.orgWidth = self.width
-            self.orgHeight = self.height
-            self.dtype = np.uint8
-            if self.formatDepth == 'RGBA16':
-                self.dtype = np.uint16
-            elif self.formatDepth == 'RGBA16F':
-                self.dtype = np.float16
-            elif self.formatDepth == 'RGBA32F':
-                self.dtype = np.float32
+            init = recvObj(self.s)
+            if not init or init[0] != 'Init':
+                raise RuntimeError("Protocol error")
+            init = init[1]
+            protocol = init.get('protocol', 0)
+            if protocol > PROTOCOL_VERSION:
+                # Tell Krita why, otherwise it only sees the connection close
+                message = f"Krita uses protocol version {protocol}, this Blender add-on only supports up to {PROTOCOL_VERSION}. Please update the add-on"
+                print("[Blender Layer] Protocol error: " + message)
+                sendObj(self.s, ('Error', message))
+                raise RuntimeError("Protocol error")
+            for attr in ['width', 'height', 'regionX', 'regionY', 'regionWidth', 'regionHeight', 'regionViewport', 'bytesPerPixel', 'colorManagement', 'bgrConversion', 'transparency', 'gizmos', 'lensZoom', 'viewMode', 'updateMode', 'renderCurrentView', 'backgroundDraw']:
+                setattr(self, attr, init[attr])
+            self.formatDepth = init['format']
+            self.baseRegion = (self.regionX, self.regionY, self.regionWidth, self.regionHeight)
+            self.canvasView = init.get('canvasView')
+            self.updateRegion()
+            self.setScale(init['scale'])
+            self.frameBudget = init.get('frameBudget', 33) / 1000
+            self.targetFps = init.get('targetFps', 30)
+            self.progressive = init.get('progressive', False)
+            self.progressiveDelay = init.get('progressiveDelay', 300) / 1000
+            self.progressive8Bit = init.get('progressive8Bit', True)
+            if self.formatDepth not in FORMATS:
+                raise RuntimeError("Unsupported pixel format " + self.formatDepth)
+
+            # Settle on what both sides support
+            capabilities = init.get('capabilities', {})
+            codecs = [codec for codec in capabilities.get('codecs', ['raw']) if codec in CODECS and (codec != 'lz4' or lz4block)] or ['raw']
+            self.features = set(capabilities.get('features', [])) & set(FEATURES)
+            self.ring = None
+            sharedMem = capabilities.get('sharedMem')
+            if sharedMem:
+                try:
+                    self.ring = SharedFrameRing(sharedMem['name'], sharedMem['generation'])
+                except Exception as e:
+                    print("[Blender Layer] Failed to attach shared memory, sending frames via the socket")
+                    print(e)
+            self.sharedMem = self.ring is not None
+            self.previewing = False
                 
             loaded = hasattr(bpy.data, 'filepath')
             
             self.prevFile = bpy.data.filepath if loaded else ''
-            sendObj(self.s, ('Init', self.transparency_support, self.prevFile))
+            sendObj(self.s, ('Init', {
+                'protocol': PROTOCOL_VERSION,
+                'transparency': self.transparency_support,
+                'file': self.prevFile,
+                'capabilities': {
+                    'transport': 'unix' if HOST.startswith('unix:') else 'tcp',
+                    'codecs': codecs,
+                    'format': self.formatDepth,
+                    'sharedMem': self.sharedMem,
+                    'features': sorted(self.features)
+                }
+            }))
             if loaded:
                 self.updatePoseLib()
                     
-            if self.sharedMem:
-                self.shm = shared_memory.SharedMemory(name=(f'krita_blender_layer:{PORT}'))
-            else:
-                self.shm = None
+            self.codecs = CodecSelector(codecs)
             bpy.app.timers.register(self.onUpdate, persistent = True)
             self.drawHandler = bpy.types.SpaceView3D.draw_handler_add(self.onDraw, (), 'WINDOW', 'POST_PIXEL' ) 
             bpy.app.handlers.render_write.append(self.onRenderFrame)
@@ -144,6 +737,10 @@ class BlenderLayerClient():
             
             self.thread = threading.Thread(target=self.sendData, args=(), daemon=True)
             self.thread.start()
+            self.convertThread = threading.Thread(target=self.convertData, args=(), daemon=True)
+            self.convertThread.start()
+            self.recvThread = threading.Thread(target=self.recvData, args=(), daemon=True)
+            self.recvThread.start()
                   
             if loaded:
                 self.tagForRedraw()
@@ -161,6 +758,8 @@ class BlenderLayerClient():
              
         self.connected = False
         self.requestDisconnect = False
+        self.sendQueue.wake()
+        self.readbackReady.set()
         if not atexit:
             loaded = hasattr(bpy.data, 'filepath')
             if loaded:
@@ -168,6 +767,12 @@ class BlenderLayerClient():
         try:
             if self.thread:
                 self.thread.join()
+            if self.convertThread:
+                self.convertThread.join()
+            if self.recvThread:
+                # Wake the receiving thread up, it may be blocked waiting for Krita
+                self.s.shutdown(socket.SHUT_RDWR)
+                self.recvThread.join()
         except Exception as e:
             print(e)
 
@@ -198,13 +803,14 @@ class BlenderLayerClient():
             print(e)
 
         try:
-            if self.shm:
-                self.shm.close()
+            if self.ring:
+                self.ring.close()
+                self.ring = None
         except Exception as e:
             print(e)          
            
         if not atexit:
-            self.freeOffscreen()
+            self.freeOffscreens()
 
         print('[Blender Layer] Disconnected') 
 
@@ -274,7 +880,7 @@ class BlenderLayerClient():
     @persistent
     def onFileLoaded(self, scene, b):
         self.sendMessage(('file', bpy.data.filepath))
-        self.freeOffscreen()
+        self.freeOffscreens()
         self.updatePoseLib()
         self.active_space = None
         self.active_region = None
@@ -282,34 +888,47 @@ class BlenderLayerClient():
 
     @persistent
     def onDepsGraphChanged(self, scene, depsGraph):
+        # Any change to the scene makes the next live frame worth rendering
+        self.depsgraphGeneration = self.depsgraphGeneration + 1
         numIds = len(depsGraph.ids)
-        flag = False
-        for update in depsGraph.updates:
-            if isinstance(update.id, bpy.types.Action):
-                flag = True
-                
-        if numIds != self.prevNumIds:
-            flag = True
-        if flag:
-            self.updatePoseLib(False)
+        changed = self.poseIndex.update(depsGraph, numIds != self.prevNumIds)
         self.prevNumIds = numIds
+        if changed:
+            self.sendPoseLibDiff()
         
     def updatePoseLib(self, clear = True):
-        armatures = {}
-        for obj in bpy.data.objects:
-            if obj.type == 'MESH':
-                for m in obj.modifiers:
-                    if m.type == 'ARMATURE' and m.object:
-                        armatures[m.object.name] = None
-        armatures = list(armatures)
+        # Full rescan, only needed for a new file or when Krita's list turned out to be wrong
+        self.poseIndex.rescan()
+        armatures = self.poseIndex.armatures()
         if self.prevArmatures != armatures:
             self.prevArmatures = armatures
             self.sendMessage(('armatures', armatures))
         
-        poselib = [a.name for a in bpy.data.actions if a.asset_data]
+        poselib = self.poseIndex.poseLib()
         if self.prevPoseLib != poselib:
             self.prevPoseLib = poselib
             self.sendMessage(('poselib', poselib, clear))
+
+    def sendPoseLibDiff(self):
+        if self.prevArmatures is None or self.prevPoseLib is None:
+            return self.updatePoseLib(False)
+        armatures = self.poseIndex.armatures()
+        current = set(armatures)
+        previous = set(self.prevArmatures)
+        added = [name for name in armatures if name not in previous]
+        removed = [name for name in self.prevArmatures if name not in current]
+        self.prevArmatures = armatures
+        if added or removed:
+            self.sendMessage(('armaturesDiff', added, removed))
+
+        poselib = self.poseIndex.poseLib()
+        current = set(poselib)
+        previous = set(self.prevPoseLib)
+        added = [name for name in poselib if name not in previous]
+        removed = [name for name in self.prevPoseLib if name not in current]
+        self.prevPoseLib = poselib
+        if added or removed:
+            self.sendMessage(('poselibDiff', added, removed))
         
     def getPosePreview(self, action):
         return np.array(action.preview.image_pixels, copy=False).ravel(order = 'F').reshape(128, 128)[::-1,:].ravel().tobytes()
@@ -324,15 +943,17 @@ class BlenderLayerClient():
                     if region.type == 'WINDOW':
                         region.tag_redraw()                        
         
-    def freeOffscreen(self):
+    def releaseOffscreen(self):
+        # The offscreen goes back to the pool, the next draw picks the one matching the new settings
+        self.buf = []
+        self.offscreen = None
+
+    def freeOffscreens(self):
         try:
-            if self.offscreen:
-                self.buf = []
-                self.offscreen.free()
+            self.offscreens.clear()
         except Exception as e:
             print(e)
-        self.buf = []
-        self.offscreen = None
+        self.releaseOffscreen()
 
     def onUpdate(self):    
         if self.requestDisconnect:
@@ -381,9 +1002,10 @@ class BlenderLayerClient():
             self.active_region = region
 
         flag = False
+        msgs = self.recvQueue.drain()
         try:
-            while not self.recvQueue.empty():
-                msg = self.recvQueue.get()
+            while msgs:
+                msg = msgs.pop(0)
                 type = msg[0]
                 if type == 'rotate':
                     if space:
@@ -420,30 +1042,34 @@ class BlenderLayerClient():
                         space.shading.type = shading
                     flag = True
                 elif type == 'region':
-                    if self.regionWidth != msg[3] or self.regionHeight != msg[4]:
-                        self.freeOffscreen()
-                    if msg[3] > self.orgWidth or msg[4] > self.orgHeight:
-                        self.sharedMem = False
-                    self.regionX = msg[1]
-                    self.regionY = msg[2]
-                    self.regionWidth = msg[3]
-                    self.regionHeight = msg[4]
+                    self.baseRegion = (msg[1], msg[2], msg[3], msg[4])
                     self.regionViewport = msg[5]
+                    self.updateRegion()
                     self.updateFlag = False
+                    self.keyframeRequested = True
                     self.sendMessage(('clear', True))
+                elif type == 'canvasView':
+                    # Parts that scrolled out of view keep their pixels in Krita, no need to clear
+                    self.canvasView = msg[1]
+                    self.updateRegion()
+                    if self.updateMode != 2:
+                        self.requestFrame = True
+                        region.tag_redraw()
                 elif type == 'renderCurrentView':
                     self.renderCurrentView = msg[1]
                 elif type == 'resize':
-                    self.freeOffscreen()
-                    if msg[1] > self.orgWidth or msg[2] > self.orgHeight:
-                        self.sharedMem = False
+                    self.releaseOffscreen()
                     self.width = msg[1]
                     self.height = msg[2]
+                    self.keyframeRequested = True
+                elif type == 'sharedMem':
+                    self.pendingRing = (msg[1], msg[2])
+                    self.sendQueue.wake()
                 elif type == 'scale':
-                    self.scale = 2 ** msg[1]
-                    self.freeOffscreen()
-                elif type == 'framerateScale':
-                    self.framerateScale = 4 ** msg[1]
+                    self.setScale(msg[1])
+                    self.releaseOffscreen()
+                elif type == 'targetFps':
+                    self.targetFps = msg[1]
                 elif type == 'viewMode':
                     self.viewMode = msg[1]
                 elif type == 'updateMode':
@@ -508,7 +1134,7 @@ class BlenderLayerClient():
                         bpy.context.view_layer.objects.active = armature
                         bpy.ops.object.mode_set(mode='POSE', toggle=False)
 
-                    self.updatePoseLib()
+                    # The appended armatures and poses reach Krita with the next depsgraph update
                     self.requestDelayedFrame = True
                     self.sendMessage(('status', f"Added {msg[1]}"))
                 elif type == 'render' or type == 'renderAnimation':
@@ -634,6 +1260,11 @@ class BlenderLayerClient():
                 elif type == 'requestFrame':
                     self.requestFrame = True
                     region.tag_redraw()                        
+                elif type == 'requestKeyframe':
+                    self.keyframeRequested = True
+                    self.requestFrame = True
+                    if region:
+                        region.tag_redraw()
                 elif type == 'assistants':
                     if space:
                         vm, pm = self.getMats(bpy.context, space)              
@@ -663,6 +1294,7 @@ class BlenderLayerClient():
                 elif type == 'file':
                     bpy.ops.wm.open_mainfile(filepath=msg[1])
                     self.requestDelayedFrame = True
+                    # The rest is handled on the next update, once the new file is set up
                     break
                 else:
                     print("[Blender Layer] Received unrecognized message type: ", type)  
@@ -673,6 +1305,8 @@ class BlenderLayerClient():
         except Exception as e:
             print(e)
             self.sendMessage(('status', str(e)))
+        if msgs:
+            self.recvQueue.putBack(msgs)
 
         if space and space.region_3d:
             rot = mathutils.Quaternion(space.region_3d.view_rotation).to_euler()
@@ -682,10 +1316,15 @@ class BlenderLayerClient():
             engine = bpy.context.scene.render.engine
             
             if flag:
+                self.scaler.navigate()
+                self.lastNavigation = time.perf_counter()
                 if space.region_3d.view_perspective == 'CAMERA':
                     space.region_3d.view_perspective = 'PERSP'
                 space.region_3d.update()
             else:
+                if self.prevRot != rot or self.prevLens != lens:
+                    self.scaler.navigate()
+                    self.lastNavigation = time.perf_counter()
                 if self.prevRot != rot:
                     roll = -rot.y
                     self.sendMessage(('rotate', rot.x, rot.z, roll))
@@ -704,9 +1343,9 @@ class BlenderLayerClient():
                 self.prevFile = bpy.data.filepath
 
             if self.prevShading != shading or self.prevEngine != engine:
-                self.freeOffscreen()
+                self.releaseOffscreen()
                 
-            if self.isAnimation and not self.isRendering and bpy.context.scene.frame_current != self.animFrame:
+            if self.isAnimation and not self.isRendering and not self.pendingTiles and bpy.context.scene.frame_current != self.animFrame:
                 bpy.context.scene.frame_set(self.animFrame)
                 
             self.prevRot = rot
@@ -714,6 +1353,21 @@ class BlenderLayerClient():
             self.prevOrtho = ortho
             self.prevShading = shading
             self.prevEngine = engine
+
+            if self.adaptiveScale and not self.isAnimation and not self.isRendering:
+                self.updateAdaptiveScale()
+
+            if self.progressive and self.updateMode != 2 and not self.isAnimation and not self.isRendering:
+                self.updatePreviewing()
+            
+            if self.updateMode == 0 and self.liveFramePending and self.liveFrameDue():
+                # A redraw came in while no frame was due, render it now
+                self.liveFramePending = False
+                self.tagForRedraw()
+            
+            if self.tilesWaiting and not self.tileQueue:
+                self.tilesWaiting = False
+                self.tagForRedraw()
             
             if self.requestFrame or self.updateMode == 0:
                 self.ticksWaitingForFrame = self.ticksWaitingForFrame + 1
@@ -722,11 +1376,101 @@ class BlenderLayerClient():
                 elif self.ticksWaitingForFrame == 120:
                     self.sendMessage(('status', "Waiting for on draw event... Make sure Blender is not minimized"))
             
-            if self.backgroundDraw and (self.requestFrame or self.updateMode == 0 or self.isAnimation and not self.isRendering):
+            if self.backgroundDraw and (self.requestFrame or self.updateMode == 0 or self.pendingTiles or self.isAnimation and not self.isRendering):
                 self.draw(space, region)
                 
         return 0.0166
     
+    def liveFrameDue(self):
+        # Live mode renders once the frame interval passed and Krita took enough of the frames in flight
+        if time.perf_counter() < self.nextFrameTime or self.updateFlag or self.tileQueue or self.pendingTiles:
+            return False
+        return 'frameAcks' not in self.features or (self.frameSequence - self.ackedSequence) & 0xffffffff < FRAME_CREDITS
+
+    def liveFrameChanged(self, context, space):
+        # Live frames are only rendered when the scene, the view or what Krita asked for changed
+        vm, pm = self.getMats(context, space)
+        key = (tuple(map(tuple, vm)), tuple(map(tuple, pm)), propertySnapshot(space.shading), propertySnapshot(space.overlay), context.scene.render.engine, context.scene.frame_current, self.depsgraphGeneration,
+            self.regionX, self.regionY, self.regionWidth, self.regionHeight, self.renderSettings(), self.transparency, self.gizmos, self.colorManagement)
+        now = time.perf_counter()
+        if key != self.liveKey or self.requestFrame or self.keyframeRequested:
+            self.liveKey = key
+            self.liveChanged = now
+            return True
+        # Material preview and rendered shading keep adding samples for a while after a change
+        return space.shading.type in ('MATERIAL', 'RENDERED') and now - self.liveChanged < LIVE_REFINE_TIME
+
+    def scheduleLiveFrame(self):
+        now = time.perf_counter()
+        interval = 1 / self.targetFps
+        # Keep the pace steady, but don't try to catch up on frames that were missed
+        self.nextFrameTime = self.nextFrameTime + interval if now - self.nextFrameTime < interval else now + interval
+
+    def ringCredit(self):
+        # The ring is written round-robin, so the slot written next has to hold a frame Krita already acknowledged
+        if not self.sharedMem or 'frameAcks' not in self.features:
+            return True
+        return (self.frameSequence - self.ackedSequence) & 0xffffffff < max(self.ring.slots - 1, 1)
+
+    def setScale(self, index):
+        self.adaptiveScale = index == ADAPTIVE_SCALE
+        self.scale = 1 if self.adaptiveScale else 2 ** index
+
+    def updateAdaptiveScale(self):
+        scale = self.scaler.choose(self.scale, self.regionWidth, self.regionHeight, self.frameBudget)
+        if scale != self.scale:
+            self.scale = scale
+            self.releaseOffscreen()
+            if scale == 1 and self.updateMode == 1:
+                # The view settled, replace the coarse frame with a full resolution one
+                self.requestFrame = True
+                self.tagForRedraw()
+
+    def updatePreviewing(self):
+        previewing = time.perf_counter() - self.lastNavigation < self.progressiveDelay
+        if previewing != self.previewing:
+            self.previewing = previewing
+            self.releaseOffscreen()
+            if not previewing:
+                # The view stayed still long enough, refine the quick frames with a full quality one
+                self.requestFrame = True
+                self.tagForRedraw()
+
+    def renderSettings(self):
+        # Scale and format of the next frame, previews trade resolution and depth for speed
+        scale = max(self.scale, self.viewScale)
+        if not self.previewing:
+            return scale, self.formatDepth
+        format = 'RGBA8' if self.progressive8Bit and 'rgba8Frames' in self.features else self.formatDepth
+        return max(scale, PROGRESSIVE_SCALE), format
+
+    def updateRegion(self):
+        # Following Krita's canvas narrows the region down to the visible part, rendered at the resolution it is shown with
+        x, y, w, h = self.baseRegion
+        viewScale = 1
+        if self.canvasView:
+            vx, vy, vw, vh, zoom = self.canvasView
+            left = max(x, vx)
+            top = max(y, vy)
+            right = min(x + w, vx + vw)
+            bottom = min(y + h, vy + vh)
+            if right > left and bottom > top:
+                x, y, w, h = left, top, right - left, bottom - top
+            viewScale = max([s for s in ADAPTIVE_SCALES if s * zoom <= 1 and s <= min(w, h)], default = 1)
+        if w != self.regionWidth or h != self.regionHeight or viewScale != self.viewScale:
+            self.releaseOffscreen()
+        self.regionX = x
+        self.regionY = y
+        self.regionWidth = w
+        self.regionHeight = h
+        self.viewScale = viewScale
+
+    def viewportRect(self):
+        # The projection is framed on this rect, the rendered region is a window into it
+        if self.regionViewport:
+            return (0, 0, self.width, self.height)
+        return self.baseRegion
+
     def onDraw(self):
         self.active_space = bpy.context.space_data
         self.active_region = bpy.context.region
@@ -739,103 +1483,247 @@ class BlenderLayerClient():
         if self.connected and not self.backgroundDraw:
             self.draw(self.active_space, self.active_region)
             
+    def convertData(self):
+        # Middle of the pipeline, while Blender draws the next frame this converts one and the sending thread transmits the one before
+        try:
+            while self.connected:
+                self.readbackReady.wait()
+                self.readbackReady.clear()
+                while self.connected:
+                    job = None
+                    if self.updateFlag:
+                        self.updateFlag = False
+                        job = (self.buf,) + self.bufRegion + (self.bufScale, self.bufFormat, None)
+                    elif self.tileQueue:
+                        job = self.tileQueue.popleft()
+                    if not job:
+                        break
+                    packet = self.convertFrame(*job)
+                    if packet:
+                        while self.connected and not self.pipelineSlots.acquire(timeout = KEEPALIVE_INTERVAL):
+                            pass
+                        self.converted.append(packet)
+                        self.sendQueue.wake()
+        except Exception as e:
+            print("[Blender Layer] Exception while converting a frame")
+            print(e)
+            self.requestDisconnect = True
+
+    def convertFrame(self, buf, x, y, regionWidth, regionHeight, scale, format, tile):
+        frameStart = time.perf_counter()
+        h = regionHeight // scale
+        w = regionWidth // scale
+        if not (len(buf) == h and len(buf[0]) == w or tile is not None and len(buf) >= h and len(buf[0]) >= w):
+            print("[Blender Layer] Warning: Ignorig frame with outdated dimensions")
+            return None
+        framePixels = w * h if tile is None else 0
+        out = self.converter.convert(buf, len(buf), len(buf[0]), DTYPES[format], self.bgrConversion)
+        b = out
+        if tile is not None:
+            # The last tiles of a row or column may be a few pixels smaller than the offscreen, their part of the image is the top left
+            b = b[:h, :w]
+        type = 'update'
+        frame = None
+        if self.isAnimation and not self.isRendering and (tile is None or tile == 0):
+            type = 'updateFrame'
+            frame = self.animFrame
+            self.sendMessage(('updateProgress', self.animFrame, self.animStart, self.animEnd))
+            self.animFrame = self.animFrame + self.animSteps
+            if self.animFrame > self.animEnd:
+                self.isAnimation = False
+                self.updateFlag = False
+                self.sendMessage(('updateProgress', self.animEnd, self.animStart, self.animEnd))
+
+        # A frame identical to the last one delivered for its rect changes nothing in Krita
+        rect = (x, y, w * scale, h * scale)
+        digest = (frameDigest(b), scale, format)
+        if type == 'update' and not self.keyframeRequested and self.deliveredDigests.get(rect) == digest:
+            return None
+        if type == 'updateFrame' or self.keyframeRequested:
+            # Krita may have cleared the layer or moved to another animation frame since
+            self.deliveredDigests.clear()
+        if type != 'updateFrame':
+            # Whatever overlaps the new frame no longer shows what it delivered
+            for other in [other for other in self.deliveredDigests if other != rect and rectsOverlap(other, rect)]:
+                del self.deliveredDigests[other]
+            self.deliveredDigests[rect] = digest
+
+        # Send only the tiles that changed since the previous frame, unless Krita needs a full one
+        key = (x, y, w, h, scale, format)
+        rects = None
+        if type == 'update' and tile is None and 'updateTile' in self.features and not self.keyframeRequested and self.prevFrame is not None and self.prevFrameKey == key:
+            rects = changedRects(b, self.prevFrame, TILE_SIZE)
+            if sum(rw * rh for (rx, ry, rw, rh) in rects) * 2 > w * h:
+                rects = None
+            elif len(rects) == 0:
+                # Nothing changed, the previous frame stays the one to compare against
+                return None
+        self.prevFrame = b if type == 'update' and tile is None else None
+        self.prevFrameKey = key
+        
+        if rects is None:
+            self.keyframeRequested = False
+            rects = [(0, 0, w, h)]
+            if type == 'update' and tile is None and 'updateTrimmed' in self.features and self.transparency and self.transparency_support:
+                # Krita clears whatever the previous frames covered outside of the box
+                type = 'updateTrimmed'
+                rects = [alphaBox(b)]
+        else:
+            type = 'updateTile'
+        parts = [b if rw == w and rh == h else b[ry:ry + rh, rx:rx + rw] for (rx, ry, rw, rh) in rects]
+        # Krita upscales reduced resolution frames itself if it can, otherwise they are sent at full size
+        sentScale = scale if 'scaledFrames' in self.features else 1
+        if scale != sentScale:
+            parts = [p.repeat(scale, axis=0).repeat(scale, axis=1) for p in parts]
+        else:
+            parts = [np.ascontiguousarray(p) for p in parts]
+        rects = [(x + rx * scale, y + ry * scale, rw * scale, rh * scale) for (rx, ry, rw, rh) in rects]
+        self.converter.commit(out)
+        return (type, x, y, w * scale, h * scale, frame, rects, parts, sentScale, format, tile, framePixels, frameStart)
+
     def sendData(self):
+        lastSent = time.perf_counter()
         try:
             while self.connected:
                 msgs = []
+                frameMsgs = []
+                framePixels = 0
 
-                if self.updateFlag:
-                    self.updateFlag = False
-                    
-                    scale = self.scale
-                    x = self.regionX
-                    y = self.regionY
-                    h = self.regionHeight // scale
-                    w = self.regionWidth // scale
-                    if len(self.buf) == h and len(self.buf[0]) == w:
-                        b = np.array(self.buf, copy=False, dtype=self.dtype).ravel(order = 'F')
-                        if self.bgrConversion:
-                            b = b.reshape(h, w, 4)[::-1,:,[2, 1, 0, 3]]
-                        else:
-                            b = b.reshape(h, w, 4)[::-1,:,[0, 1, 2, 3]]
-                        if scale != 1:
-                            b = b.repeat(scale, axis=0).repeat(scale, axis=1)
-                        b = b.ravel().tobytes()
-                        type = 'update'
-                        frame = None
-                        if self.isAnimation and not self.isRendering:
-                            type = 'updateFrame'
-                            frame = self.animFrame
-                            self.sendMessage(('updateProgress', self.animFrame, self.animStart, self.animEnd))
-                            self.animFrame = self.animFrame + self.animSteps
-                            if self.animFrame > self.animEnd:
-                                self.isAnimation = False
-                                self.updateFlag = False
-                                self.sendMessage(('updateProgress', self.animEnd, self.animStart, self.animEnd))
-                        if self.sharedMem:
-                            self.shm.buf[:len(b)] = b
-                            msgs.append((type, x, y, w * scale, h * scale, None, frame))
-                        else:
-                            msgs.append((type, x, y, w * scale, h * scale, b, frame))
-                    else:
-                        print("[Blender Layer] Warning: Ignorig frame with outdated dimensions")
-
-                lastType = None
-                while not self.sendQueue.empty():
-                    msg = self.sendQueue.get()
-                    type = msg[0]
-                    if type == lastType:
-                        if type == 'posePreviews':
-                            msg[1].extend(msgs[-1][1])
-                        msgs[-1] = msg
+                if self.pendingRing:
+                    name, generation = self.pendingRing
+                    self.pendingRing = None
+                    try:
+                        ring = SharedFrameRing(name, generation)
+                        if self.ring:
+                            self.ring.close()
+                        self.ring = ring
+                        self.sharedMem = True
+                        self.sendMessage(('sharedMemAttached', generation))
+                    except Exception as e:
+                        print("[Blender Layer] Failed to remap shared memory")
+                        print(e)
+
+                packet = None
+                if self.converted and self.ringCredit():
+                    packet = self.converted.popleft()
+                    self.pipelineSlots.release()
+
+                if packet:
+                    type, x, y, w, h, frame, rects, parts, sentScale, format, tile, framePixels, frameStart = packet
+                    self.frameSequence = (self.frameSequence + 1) & 0xffffffff
+                    slot, offsets = self.ring.write(self.frameSequence, parts) if self.sharedMem else (None, None)
+                    if slot is not None:
+                        msgs.append((type, x, y, w, h, None, frame, self.frameSequence, slot, self.ring.generation, [rect + (offset,) for rect, offset in zip(rects, offsets)], sentScale, format))
                     else:
-                        msgs.append(msg)
-                    lastType = type
+                        for (rx, ry, rw, rh), p in zip(rects, parts):
+                            frameMsgs.append((type, rx, ry, rw, rh, format, self.frameSequence, frame, sentScale, p))
+
+                controlMsgs = self.sendQueue.drain()
 
                 if not self.connected:
                     break
-                  
-                sendObj(self.s, msgs)
-                
-                if not self.connected:
-                    break
-                    
-                msgs = recvObj(self.s)
-                while msgs == 'wait':
-                    msgs = recvObj(self.s)
-                if msgs:                        
-                    for msg in msgs:
-                        self.recvQueue.put(msg)
 
-                #time.sleep(0.333)
+                if not msgs and not frameMsgs and not controlMsgs:
+                    # Nothing to do until a frame or message is queued, or the keepalive is due
+                    remaining = KEEPALIVE_INTERVAL - (time.perf_counter() - lastSent)
+                    if remaining > 0:
+                        self.sendQueue.wait(remaining)
+                        continue
+
+                # Messages go out ahead of the pixels, so they don't wait for a large frame
+                if controlMsgs:
+                    sendObj(self.s, controlMsgs)
+                for (type, x, y, w, h, format, sequence, frame, sentScale, pixels) in frameMsgs:
+                    start = time.perf_counter()
+                    chosen = self.codecs.choose()
+                    codec, bodies = encodeFrame(chosen, pixels)
+                    encoded = time.perf_counter()
+                    size = sendFrame(self.s, type, x, y, w, h, format, sequence, frame, sentScale, codec, bodies)
+                    self.codecs.record(chosen, pixels.nbytes, size, encoded - start, time.perf_counter() - encoded)
+                if msgs or frameMsgs or not controlMsgs:
+                    sendObj(self.s, msgs)
+                lastSent = time.perf_counter()
+                if framePixels:
+                    self.scaler.record(self.drawTime + lastSent - frameStart, framePixels)
         except Exception as e:
             print("[Blender Layer] Exception while communicating with Krita")
             print(e)                     
             self.requestDisconnect = True
+
+    def recvData(self):
+        # Krita's messages arrive independently of the frames being sent
+        try:
+            while self.connected:
+                msgs = recvObj(self.s)
+                if msgs is None:
+                    if self.connected:
+                        print("[Blender Layer] Connection closed by Krita")
+                        self.requestDisconnect = True
+                    break
+                for msg in msgs:
+                    if msg[0] == 'ack':
+                        # Frees a frame credit, the sending loop may be waiting for it
+                        self.ackedSequence = msg[1]
+                        self.sendQueue.wake()
+                    else:
+                        self.recvQueue.put(msg)
+        except Exception as e:
+            if self.connected:
+                print("[Blender Layer] Exception while receiving from Krita")
+                print(e)
+                self.requestDisconnect = True
             
     def draw(self, space, region):
         try:            
             context = bpy.context
-            self.frame = self.frame + 1
+            liveDue = self.updateMode == 0 and self.connected and not self.isRendering and self.liveFrameDue()
+            liveFrame = liveDue and self.liveFrameChanged(context, space)
             original_overlays = space.overlay.show_overlays
             gizmos = self.gizmos or (space.shading.type == 'RENDERED' and bpy.context.scene.render.engine == 'CYCLES')
              
-            if self.connected and not self.isRendering and (self.updateMode == 0 and self.frame % self.framerateScale == 0 or self.updateMode != 0 and self.requestFrame or self.isAnimation and context.scene.frame_current == self.animFrame):
-                if not self.offscreen:
-                    self.offscreen = gpu.types.GPUOffScreen(self.regionWidth // self.scale, self.regionHeight // self.scale, format=self.formatDepth)
+            if self.connected and self.pendingTiles:
+                # Only one tile waits for the converter at a time, the rest are drawn as it takes them
+                if not self.tileQueue:
+                    space.overlay.show_overlays = gizmos
+                    self.drawNextTile(context, space, region)
+                    space.overlay.show_overlays = original_overlays
+                else:
+                    self.tilesWaiting = True
+            elif self.connected and not self.isRendering and not self.tileQueue and (liveFrame or self.updateMode != 0 and self.requestFrame or self.isAnimation and context.scene.frame_current == self.animFrame):
+                scale, format = self.renderSettings()
+                maxSize = self.maxRenderSize()
+                tiled = self.regionWidth // scale > maxSize or self.regionHeight // scale > maxSize or self.offscreens.size((self.regionWidth // scale, self.regionHeight // scale, format)) > MAX_RENDER_BYTES
+                if not tiled:
+                    self.offscreen = self.offscreens.get(self.regionWidth // scale, self.regionHeight // scale, format, space.shading.type, context.scene.render.engine)
                                   
                 space.overlay.show_overlays = gizmos                  
-                vm, pm = self.getMats(context, space)
-                if self.transparency_support and self.transparency:
-                    self.offscreen.draw_view3d( context.scene, context.view_layer, space, region, vm, pm, do_color_management=self.colorManagement, draw_background=False)
+                drawStart = time.perf_counter()
+                if tiled:
+                    self.planTiles(context, space, scale, format, maxSize)
+                    self.drawNextTile(context, space, region)
                 else:
-                    self.offscreen.draw_view3d( context.scene, context.view_layer, space, region, vm, pm, do_color_management=self.colorManagement)
+                    vm, pm = self.getMats(context, space)
+                    self.drawOffscreen(context, space, region, vm, pm)
+                    self.buf = self.offscreen.texture_color.read()
+                    self.bufScale = scale
+                    self.bufFormat = format
+                    self.bufRegion = (self.regionX, self.regionY, self.regionWidth, self.regionHeight)
                 space.overlay.show_overlays = original_overlays           
-                self.buf = self.offscreen.texture_color.read()
-                self.updateFlag = not self.isRendering and (self.updateMode == 0 and self.frame % self.framerateScale == 0 or self.updateMode != 0 and self.requestFrame or self.isAnimation and context.scene.frame_current == self.animFrame)
+                self.drawTime = time.perf_counter() - drawStart
+                self.updateFlag = not tiled and not self.isRendering and (liveFrame or self.updateMode != 0 and self.requestFrame or self.isAnimation and context.scene.frame_current == self.animFrame)
+                if liveFrame:
+                    self.scheduleLiveFrame()
+                    self.liveFramePending = False
                 self.requestFrame = False
+                if self.updateFlag:
+                    self.readbackReady.set()
             elif self.updateMode == 0:            
-                space.overlay.show_overlays = original_overlays           
+                space.overlay.show_overlays = original_overlays
+                # Only a redraw that came in too early needs another one, an unchanged view doesn't
+                self.liveFramePending = not liveDue
+            elif self.tileQueue:
+                # The tiles of the previous frame are still being sent, draw again once they are
+                self.tilesWaiting = True           
             if self.ticksWaitingForFrame >= 120:
                 self.sendMessage(('status', "Updated frame"))
             self.ticksWaitingForFrame = 0
@@ -845,7 +1733,55 @@ class BlenderLayerClient():
             self.sendMessage(('status', str(e)))
             print(e)
 
-    def getMats(self, context, space):
+    def drawOffscreen(self, context, space, region, vm, pm):
+        if self.transparency_support and self.transparency:
+            self.offscreen.draw_view3d( context.scene, context.view_layer, space, region, vm, pm, do_color_management=self.colorManagement, draw_background=False)
+        else:
+            self.offscreen.draw_view3d( context.scene, context.view_layer, space, region, vm, pm, do_color_management=self.colorManagement)
+
+    def planTiles(self, context, space, scale, format, maxSize):
+        # Splits the region into even tiles, the view is taken now so all of them show the same frame
+        w = self.regionWidth // scale
+        h = self.regionHeight // scale
+        columns = -(-w // maxSize)
+        rows = -(-h // maxSize)
+        tileWidth = -(-w // columns)
+        tileHeight = -(-h // rows)
+        while self.offscreens.size((tileWidth, tileHeight, format)) > MAX_RENDER_BYTES:
+            # Split the longer side further until a tile fits the memory budget
+            if tileWidth >= tileHeight:
+                columns = columns + 1
+            else:
+                rows = rows + 1
+            tileWidth = -(-w // columns)
+            tileHeight = -(-h // rows)
+        self.tileOffscreenKey = (tileWidth, tileHeight, format, space.shading.type, context.scene.render.engine)
+        tiles = [(tx, ty) for ty in range(0, h, tileHeight) for tx in range(0, w, tileWidth)]
+        for i, (tx, ty) in enumerate(tiles):
+            x = self.regionX + tx * scale
+            y = self.regionY + ty * scale
+            vm, pm = self.getMats(context, space, (x, y, tileWidth * scale, tileHeight * scale))
+            self.pendingTiles.append((vm, pm, x, y, min(tileWidth, w - tx) * scale, min(tileHeight, h - ty) * scale, scale, format, i))
+
+    def drawNextTile(self, context, space, region):
+        vm, pm, x, y, w, h, scale, format, i = self.pendingTiles.popleft()
+        self.offscreen = self.offscreens.get(*self.tileOffscreenKey)
+        self.drawOffscreen(context, space, region, vm, pm)
+        self.tileQueue.append((self.offscreen.texture_color.read(), x, y, w, h, scale, format, i))
+        self.readbackReady.set()
+        # The next tile is drawn once the converter took this one
+        self.tilesWaiting = len(self.pendingTiles) > 0
+
+    def maxRenderSize(self):
+        try:
+            return gpu.capabilities.max_texture_size_get()
+        except AttributeError:
+            return MAX_RENDER_SIZE
+
+    def getMats(self, context, space, rect = None):
+        # rect is the part of the image to project, tiles pass their own one
+        x, y, w, h = rect if rect else (self.regionX, self.regionY, self.regionWidth, self.regionHeight)
+        viewport = self.viewportRect()
         if self.viewMode == 0 and not space.region_3d.view_perspective == 'CAMERA' or (self.viewMode == 2 and self.renderCurrentView) or not context.scene.camera:
             #vm = space.region_3d.view_matrix
             #pm = space.region_3d.window_matrix.copy()
@@ -856,13 +1792,14 @@ class BlenderLayerClient():
             far = space.clip_end    
             dist = space.region_3d.view_distance
             size = space.lens / 36.0 / dist if space.region_3d.view_perspective == 'ORTHO' else space.lens / 36.0
-            ratio = self.regionWidth / self.regionHeight
+            ratio = w / h
             
-            if self.regionViewport:
-                m = max(self.width, self.height)
-                m = min(m / self.regionWidth, m / self.regionHeight)
-                shiftX =  (self.regionX - (self.width  - self.regionWidth)  / 2) / self.regionWidth  * 2.0
-                shiftY = -(self.regionY - (self.height - self.regionHeight) / 2) / self.regionHeight * 2.0
+            if (x, y, w, h) != viewport:
+                vx, vy, vw, vh = viewport
+                m = max(vw, vh)
+                m = min(m / w, m / h)
+                shiftX =  (x - vx - (vw - w) / 2) / w * 2.0
+                shiftY = -(y - vy - (vh - h) / 2) / h * 2.0
                 size *= m
             else:
                 shiftX = 0.0
@@ -886,13 +1823,14 @@ class BlenderLayerClient():
                       ( 0, 0, -1.0, 0)))        
         else:
             vm = context.scene.camera.matrix_world.inverted()
-            pm = context.scene.camera.calc_matrix_camera(context.view_layer.depsgraph, x=self.regionWidth, y=self.regionHeight)
+            pm = context.scene.camera.calc_matrix_camera(context.view_layer.depsgraph, x=w, y=h)
             
-            if self.regionViewport:
-                m = max(self.width, self.height)
-                m = min(m / self.regionWidth, m / self.regionHeight)
-                shiftX =  (self.regionX - (self.width  - self.regionWidth)  / 2) / self.regionWidth  * 2.0
-                shiftY = -(self.regionY - (self.height - self.regionHeight) / 2) / self.regionHeight * 2.0
+            if (x, y, w, h) != viewport:
+                vx, vy, vw, vh = viewport
+                m = max(vw, vh)
+                m = min(m / w, m / h)
+                shiftX =  (x - vx - (vw - w) / 2) / w * 2.0
+                shiftY = -(y - vy - (vh - h) / 2) / h * 2.0
                 pm[0][0] *= m
                 pm[1][1] *= m
                 pm[0][2] = pm[0][2] * m + shiftX
@@ -905,7 +1843,7 @@ class ConnectOperator(bpy.types.Operator):
     bl_label = "Connect to Krita"
     bl_description = "Connect to stream a 3d View into Krita (Blender Layer)"
 
-    host: bpy.props.StringProperty(name="Host", default = HOST)
+    host: bpy.props.StringProperty(name="Host", description = "Host name, or unix:<path> for a Unix domain socket", default = HOST)
     port: bpy.props.IntProperty(name="Port", default = PORT)
 
     def execute(self, context):
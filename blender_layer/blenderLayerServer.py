@@ -1,21 +1,150 @@
-import subprocess, time, socket, sys, math, struct, pickle, errno  
-from multiprocessing import shared_memory, SimpleQueue
-from PyQt5.QtCore import QRunnable, QObject, pyqtSignal, QByteArray
+import subprocess, time, socket, selectors, threading, sys, os, math, struct, pickle, errno, zlib, tempfile
+from multiprocessing import shared_memory
+from PyQt5.QtCore import Qt, QRunnable, QObject, pyqtSignal, QByteArray
 from PyQt5.QtGui import QImage
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+
+# Raised for changes an older peer can't ignore, each side refuses a peer with a newer version than its own.
+# Additions both sides can negotiate go into the capabilities instead, unknown fields and capabilities are ignored
+PROTOCOL_VERSION = 1
+# Optional protocol features this side understands
+FEATURES = ['updateTile', 'updateTrimmed', 'frameAcks']
+
+PACKET_OBJECT = 0
+PACKET_FRAME = 1
+FRAME_TYPES = ['update', 'updateFrame', 'updateTile', 'updateTrimmed']
+FORMATS = ['RGBA8', 'RGBA16', 'RGBA16F', 'RGBA32F']
+FORMAT_SIZES = [4, 8, 8, 16]
+CODECS = ['raw', 'rle', 'zlib', 'lz4']
+# Only formats QImage knows can be upscaled by Krita, the float ones need Qt 6.2
+QIMAGE_FORMATS = {'RGBA8': 'Format_RGBA8888', 'RGBA16': 'Format_RGBA64', 'RGBA16F': 'Format_RGBA16FPx4', 'RGBA32F': 'Format_RGBA32FPx4'}
+
+# kind, payload length
+packetHeader = struct.Struct('>BI')
+# type, x, y, width, height, format, sequence, frame (-1 for none), codec, scale (pixels are width / scale by height / scale)
+frameHeader = struct.Struct('>B4iBIiBB')
+# number of (literal pixels, zero pixels) runs following
+rleHeader = struct.Struct('<I')
+
+# Messages describing the view, only their latest value (or for zoom and pan the sum) per batch matters
+COALESCED_MESSAGES = {'rotate', 'lens', 'ortho', 'shading', 'region', 'canvasView', 'scale', 'viewMode', 'zoom', 'pan'}
+
+# Seconds without messages before an empty batch is sent, so the other side knows the connection is alive
+KEEPALIVE_INTERVAL = 1.0
+# Seconds without frames from Blender before the canvas lock is released
+IDLE_UNLOCK_DELAY = 0.1
+RESIZE_CHECK_INTERVAL = 0.25
+
+RING_SLOTS = 3
+RING_HEADER_SIZE = 64
+RING_READING_OFFSET = 16
+SLOT_HEADER_SIZE = 64
+# slot count, slot data size
+ringHeader = struct.Struct('<IQ')
+# slot currently read by Krita (-1 for none)
+ringReading = struct.Struct('<i')
+# seqlock counter, odd while Blender is writing
+slotLock = struct.Struct('<Q')
+# frame sequence, bytes written
+slotInfo = struct.Struct('<IQ')
 
 def sendObj(conn, obj):
     msg = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
-    msg = struct.pack('>I', len(msg)) + msg
+    msg = packetHeader.pack(PACKET_OBJECT, len(msg)) + msg
     conn.sendall(msg)
 
 def recvObj(conn):
-    raw_msglen = recvAll(conn, 4)
-    if not raw_msglen:
+    raw_header = recvAll(conn, packetHeader.size)
+    if not raw_header:
         return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
+    kind, msglen = packetHeader.unpack(raw_header)
     msg = recvAll(conn, msglen)
+    if kind != PACKET_OBJECT:
+        raise RuntimeError("Protocol error: Expected object packet")
     return pickle.loads(msg) 
 
+def unixSocketPath(port):
+    return os.path.join(tempfile.gettempdir(), f'krita_blender_layer_{port}.sock')
+
+def supportedTransports():
+    return ['tcp', 'unix'] if hasattr(socket, 'AF_UNIX') else ['tcp']
+
+def supportedCodecs():
+    return [codec for codec in CODECS if codec != 'lz4' or lz4block]
+
+def recvMsgs(conn, framePool, decodePool):
+    msgs = []
+    frames = 0
+    while True:
+        raw_header = recvAll(conn, packetHeader.size)
+        if not raw_header:
+            return None
+        kind, msglen = packetHeader.unpack(raw_header)
+        if kind == PACKET_FRAME:
+            raw_frame = recvAll(conn, frameHeader.size)
+            if not raw_frame:
+                return None
+            type, x, y, w, h, format, sequence, frame, codec, scale = frameHeader.unpack(raw_frame)
+            data = framePool.get(frames, msglen - frameHeader.size)
+            if not recvInto(conn, data):
+                return None
+            data = decodeFrame(CODECS[codec], data, (w // scale) * (h // scale) * FORMAT_SIZES[format], FORMAT_SIZES[format], decodePool, frames)
+            frames = frames + 1
+            msgs.append((FRAME_TYPES[type], x, y, w, h, data, frame if frame >= 0 else None, sequence, FORMATS[format], scale))
+        else:
+            msg = recvAll(conn, msglen)
+            if msg is None:
+                return None
+            msgs.extend(pickle.loads(msg))
+            return msgs
+
+def decodeFrame(codec, data, size, bytesPerPixel, pool, index):
+    if codec == 'raw':
+        decoded = data
+    elif codec == 'zlib':
+        decoded = zlib.decompress(data, bufsize = max(size, 1))
+    elif codec == 'lz4' and lz4block:
+        decoded = lz4block.decompress(data, uncompressed_size = size)
+    elif codec == 'rle':
+        decoded = decodeRLE(data, pool.get(index, size), bytesPerPixel)
+    else:
+        raise RuntimeError("Protocol error: Unsupported codec " + codec)
+    if len(decoded) != size:
+        raise RuntimeError("Protocol error: Frame has the wrong size after decoding")
+    return decoded
+
+def decodeRLE(data, out, bytesPerPixel):
+    count = rleHeader.unpack_from(data)[0]
+    runs = struct.unpack_from(f'<{count * 2}I', data, rleHeader.size)
+    src = rleHeader.size + count * 8
+    zeros = memoryview(bytes(max(runs[1::2], default = 0) * bytesPerPixel))
+    pos = 0
+    for i in range(0, len(runs), 2):
+        n = runs[i] * bytesPerPixel
+        out[pos:pos + n] = data[src:src + n]
+        pos = pos + n
+        src = src + n
+        n = runs[i + 1] * bytesPerPixel
+        out[pos:pos + n] = zeros[:n]
+        pos = pos + n
+    return out[:pos]
+
+def qimageFormat(format):
+    return getattr(QImage, QIMAGE_FORMATS[format], None)
+
+def convertFrame(data, w, h, scale, sourceFormat, format, smooth):
+    # data holds w / scale by h / scale pixels in sourceFormat, the returned image has to outlive the use of its bits
+    image = QImage(data, w // scale, h // scale, (w // scale) * FORMAT_SIZES[FORMATS.index(sourceFormat)], qimageFormat(sourceFormat))
+    if scale > 1:
+        image = image.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation if smooth else Qt.FastTransformation)
+    if image.format() != qimageFormat(format):
+        # Smooth scaling works premultiplied and previews can come with a lower depth than the layer
+        image = image.convertToFormat(qimageFormat(format))
+    return image
+
 def recvAll(conn, n):
     data = bytearray()
     while len(data) < n:
@@ -25,6 +154,188 @@ def recvAll(conn, n):
         data.extend(packet)
     return data
 
+def recvInto(conn, view):
+    pos = 0
+    n = len(view)
+    while pos < n:
+        received = conn.recv_into(view[pos:], n - pos)
+        if not received:
+            return False
+        pos = pos + received
+    return True
+
+def intersectRect(a, b):
+    if not a or not b:
+        return None
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def unionRect(*rects):
+    rects = [r for r in rects if r and r[2] > 0 and r[3] > 0]
+    if not rects:
+        return None
+    x0 = min(r[0] for r in rects)
+    y0 = min(r[1] for r in rects)
+    x1 = max(r[0] + r[2] for r in rects)
+    y1 = max(r[1] + r[3] for r in rects)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def subtractRect(a, b):
+    # Up to four bands of a that lie outside of b
+    if not a:
+        return []
+    c = intersectRect(a, b)
+    if not c:
+        return [a]
+    rects = []
+    if c[1] > a[1]:
+        rects.append((a[0], a[1], a[2], c[1] - a[1]))
+    if c[1] + c[3] < a[1] + a[3]:
+        rects.append((a[0], c[1] + c[3], a[2], a[1] + a[3] - c[1] - c[3]))
+    if c[0] > a[0]:
+        rects.append((a[0], c[1], c[0] - a[0], c[3]))
+    if c[0] + c[2] < a[0] + a[2]:
+        rects.append((c[0] + c[2], c[1], a[0] + a[2] - c[0] - c[2], c[3]))
+    return rects
+
+class MessageBus():
+    # Hands messages between threads of this process as they are, without pickling them through a pipe
+    def __init__(self, merges = {}, priorities = {}, coalesce = set()):
+        # merges maps a type to how two consecutive messages of it combine (None keeps both), the None key applies to all other types
+        self.merges = merges
+        self.priorities = priorities
+        # Types in coalesce are merged across the whole batch, not only when consecutive
+        self.coalesce = coalesce
+        self.condition = threading.Condition()
+        self.messages = []
+        self.woken = False
+
+    def put(self, msg):
+        with self.condition:
+            self.messages.append(msg)
+            self.condition.notify_all()
+
+    def empty(self):
+        return not self.messages
+
+    def get(self):
+        with self.condition:
+            return self.messages.pop(0)
+
+    def clear(self):
+        with self.condition:
+            self.messages = []
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def wait(self, timeout = None):
+        with self.condition:
+            if not self.messages and not self.woken:
+                self.condition.wait(timeout)
+            self.woken = False
+            return len(self.messages) > 0
+
+    def drain(self):
+        with self.condition:
+            messages = self.messages
+            self.messages = []
+        msgs = []
+        for msg in messages:
+            merge = self.merges.get(msg[0], self.merges.get(None))
+            if msgs and msgs[-1][0] == msg[0] and merge:
+                msgs[-1] = merge(msgs[-1], msg)
+            else:
+                msgs.append(msg)
+        if self.coalesce:
+            last = {}
+            for i, msg in enumerate(msgs):
+                if msg[0] in self.coalesce:
+                    if msg[0] in last:
+                        # The combined message takes the later position
+                        merge = self.merges.get(msg[0], self.merges.get(None)) or latestMessage
+                        msgs[i] = merge(msgs[last[msg[0]]], msg)
+                        msgs[last[msg[0]]] = None
+                    last[msg[0]] = i
+            msgs = [msg for msg in msgs if msg is not None]
+        msgs.sort(key = lambda msg: -self.priorities.get(msg[0], 0))
+        return msgs
+
+def latestMessage(old, new):
+    return new
+
+def sumZoom(old, new):
+    return (new[0], old[1] + new[1])
+
+def sumPan(old, new):
+    return (new[0], old[1] + new[1], old[2] + new[2])
+
+def joinPosePreviews(old, new):
+    return (new[0], new[1] + old[1])
+
+class FramePool():
+    def __init__(self):
+        self.buffers = []
+
+    def get(self, index, size):
+        while len(self.buffers) <= index:
+            self.buffers.append(bytearray())
+        if len(self.buffers[index]) < size:
+            # Replace instead of resizing, views from the previous batch may still be alive
+            self.buffers[index] = bytearray(size)
+        return memoryview(self.buffers[index])[:size]
+
+class SharedFrameRing():
+    def __init__(self, name, dataSize, generation = 0):
+        self.name = name
+        self.generation = generation
+        self.slots = RING_SLOTS
+        self.dataSize = dataSize
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER_SIZE + self.slots * (SLOT_HEADER_SIZE + dataSize))
+        ringHeader.pack_into(self.shm.buf, 0, self.slots, dataSize)
+        ringReading.pack_into(self.shm.buf, RING_READING_OFFSET, -1)
+        self.readLock = None
+
+    def slotOffset(self, slot):
+        return RING_HEADER_SIZE + slot * (SLOT_HEADER_SIZE + self.dataSize)
+
+    def beginRead(self, slot, sequence, size):
+        if slot < 0 or slot >= self.slots or size > self.dataSize:
+            return None
+        # Announce the slot first, so Blender won't start overwriting it
+        ringReading.pack_into(self.shm.buf, RING_READING_OFFSET, slot)
+        offset = self.slotOffset(slot)
+        self.readLock = slotLock.unpack_from(self.shm.buf, offset)[0]
+        written, writtenSize = slotInfo.unpack_from(self.shm.buf, offset + slotLock.size)
+        if self.readLock % 2 == 1 or written != sequence or writtenSize < size:
+            self.endRead(slot)
+            return None
+        # Only the part Blender actually wrote, handed to Krita without copying
+        return self.shm.buf[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + size]
+
+    def superseded(self, slot, sequence):
+        # Blender moved on and reused the slot for a later frame, nothing was torn
+        if slot < 0 or slot >= self.slots:
+            return False
+        written = slotInfo.unpack_from(self.shm.buf, self.slotOffset(slot) + slotLock.size)[0]
+        return 0 < (written - sequence) & 0xffffffff < 0x80000000
+
+    def endRead(self, slot):
+        lock = slotLock.unpack_from(self.shm.buf, self.slotOffset(slot))[0]
+        ringReading.pack_into(self.shm.buf, RING_READING_OFFSET, -1)
+        return lock == self.readLock
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
 instance = Krita.instance()
 
 class RunnableSignals(QObject):
@@ -40,20 +351,53 @@ class BlenderLayerServer(QRunnable):
         self.settings = settings
         self.running = False
         self.signals = RunnableSignals()
-        self.sendQueue = SimpleQueue()
+        # Navigation goes out first, pose thumbnails last
+        self.sendQueue = MessageBus({'zoom': sumZoom, 'pan': sumPan, 'posePreviews': joinPosePreviews, 'append': None, None: latestMessage}, {'zoom': 1, 'pan': 1, 'rotate': 1, 'lens': 1, 'ortho': 1, 'posePreviews': -1}, COALESCED_MESSAGES)
+        self.connection = None
         
     def sendMessage(self, msg):
         self.sendQueue.put(msg)
 
+    def writePixels(self, l, data, x, y, w, h, scale, sourceFormat, format):
+        if w // scale <= 0 or h // scale <= 0:
+            return
+        if scale > 1 or sourceFormat != format:
+            image = convertFrame(data, w, h, scale, sourceFormat, format, self.settings.smoothUpscale)
+            l.setPixelData(QByteArray.fromRawData(image.constBits().asarray(image.sizeInBytes())), x, y, w, h)
+        else:
+            l.setPixelData(QByteArray.fromRawData(data), x, y, w, h)
+
+    def sendLoop(self, conn):
+        # Runs next to the receiving loop, so messages for Blender never wait for a frame to arrive
+        lastSent = time.perf_counter()
+        try:
+            while self.running and self.connection is conn:
+                msgs = self.sendQueue.drain()
+                remaining = KEEPALIVE_INTERVAL - (time.perf_counter() - lastSent)
+                if msgs or remaining <= 0:
+                    sendObj(conn, msgs)
+                    lastSent = time.perf_counter()
+                else:
+                    self.sendQueue.wait(remaining)
+        except Exception as e:
+            if self.connection is conn:
+                print(e)
+
     def run(self):
         self.running = True
-        shm = None
+        ring = None
+        oldRing = None
         s = None
         d = None
         l = None
         locked = False
         refresh = False
         framesLocked = 0
+        appliedSequence = None
+        keyframeRequested = None
+        unixPath = None
+        # Part of the layer that may hold pixels from earlier frames
+        covered = None
             
         try:     
             d = instance.activeDocument()
@@ -93,20 +437,39 @@ class BlenderLayerServer(QRunnable):
 
             width = d.width()
             height = d.height()
-            orgWidth = width
-            orgHeight = height
+            covered = (0, 0, width, height)
         
             HOST = self.settings.host
             PORT = self.settings.port
-            MAGIC = b'BLENDER_LAYER_V1'
+            MAGIC = b'BLENDER_LAYER_V3'
   
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5.0)
-            s.bind((HOST, PORT))
+            if self.settings.unixSocket and hasattr(socket, 'AF_UNIX'):
+                socketPath = unixSocketPath(PORT)
+                if os.path.exists(socketPath):
+                    # Left behind by a crashed session, unless another Krita is still listening on it
+                    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    try:
+                        probe.connect(socketPath)
+                        raise socket.error(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        os.unlink(socketPath)
+                    finally:
+                        probe.close()
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                s.settimeout(5.0)
+                s.bind(socketPath)
+                unixPath = socketPath
+            else:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.settimeout(5.0)
+                s.bind((HOST, PORT))
             s.listen(1)
             
             if self.settings.sharedMem:
-                shm = shared_memory.SharedMemory(name=(f'krita_blender_layer:{PORT}'), create=True, size=bytesPerPixel * orgWidth * orgHeight)
+                ring = SharedFrameRing(f'krita_blender_layer:{PORT}', bytesPerPixel * width * height)
+            framePool = FramePool()
+            decodePool = FramePool()
+            zeroPool = FramePool()
             i = 0
             resultStr = ''
             while self.running:
@@ -121,8 +484,7 @@ class BlenderLayerServer(QRunnable):
                         time.sleep(5.0)
                         continue
 
-                    while not self.sendQueue.empty():
-                        self.sendQueue.get()
+                    self.sendQueue.clear()
                             
                     if not self.settings.region:
                         self.settings.regionX = 0
@@ -130,10 +492,69 @@ class BlenderLayerServer(QRunnable):
                         self.settings.regionWidth = width
                         self.settings.regionHeight = height
                     l.setLocked(True)
-
-                    sendObj(conn, ('Init', width, height, self.settings.regionX, self.settings.regionY, self.settings.regionWidth, self.settings.regionHeight, self.settings.regionViewport, self.settings.scale, self.settings.framerateScale, format, bytesPerPixel, self.settings.colorManageBlender, convertBGR, self.settings.transparency, self.settings.gizmos, self.settings.lensZoom, self.settings.viewMode, self.settings.updateMode, self.settings.renderCurrentView, self.settings.sharedMem, self.settings.backgroundDraw))
-                    self.signals.connected.emit(True, recvObj(conn))
                     
+                    if oldRing:
+                        oldRing.close()
+                        oldRing = None
+
+                    self.connection = conn
+                    features = FEATURES + (['scaledFrames'] if qimageFormat(format) is not None else [])
+                    if format != 'RGBA8' and qimageFormat(format) is not None and qimageFormat('RGBA8') is not None:
+                        # Previews during navigation may be sent in 8 bit and converted here
+                        features = features + ['rgba8Frames']
+                    sendObj(conn, ('Init', {
+                        'protocol': PROTOCOL_VERSION,
+                        'width': width,
+                        'height': height,
+                        'regionX': self.settings.regionX,
+                        'regionY': self.settings.regionY,
+                        'regionWidth': self.settings.regionWidth,
+                        'regionHeight': self.settings.regionHeight,
+                        'regionViewport': self.settings.regionViewport,
+                        'canvasView': self.settings.canvasView,
+                        'scale': self.settings.scale,
+                        'targetFps': self.settings.targetFps,
+                        'frameBudget': self.settings.frameBudget,
+                        'format': format,
+                        'bytesPerPixel': bytesPerPixel,
+                        'colorManagement': self.settings.colorManageBlender,
+                        'bgrConversion': convertBGR,
+                        'transparency': self.settings.transparency,
+                        'gizmos': self.settings.gizmos,
+                        'lensZoom': self.settings.lensZoom,
+                        'viewMode': self.settings.viewMode,
+                        'updateMode': self.settings.updateMode,
+                        'renderCurrentView': self.settings.renderCurrentView,
+                        'backgroundDraw': self.settings.backgroundDraw,
+                        'progressive': self.settings.progressive,
+                        'progressiveDelay': self.settings.progressiveDelay,
+                        'progressive8Bit': self.settings.progressive8Bit,
+                        'capabilities': {
+                            'transports': supportedTransports(),
+                            'codecs': supportedCodecs() if self.settings.compression else ['raw'],
+                            'formats': [format] + (['RGBA8'] if 'rgba8Frames' in features else []),
+                            'sharedMem': {'name': ring.name, 'generation': ring.generation, 'size': ring.dataSize} if ring else None,
+                            'features': features
+                        }
+                    }))
+                    init = recvObj(conn)
+                    if init and init[0] == 'Error':
+                        # Blender refused the connection, e.g. because this plugin is newer than its add-on
+                        raise RuntimeError(i18n("Protocol error: {0}").format(init[1]))
+                    if not init or init[0] != 'Init':
+                        raise RuntimeError(i18n("Protocol error: Expected Init from Blender"))
+                    init = init[1]
+                    if init.get('protocol', 0) > PROTOCOL_VERSION:
+                        raise RuntimeError(i18n("Protocol error: Blender uses protocol version {0}, this plugin only supports up to {1}. Please update the plugin").format(init.get('protocol'), PROTOCOL_VERSION))
+                    # What Blender settled on out of the capabilities offered above
+                    accepted = init.get('capabilities', {})
+                    if ring and not accepted.get('sharedMem', False):
+                        self.signals.error.emit(i18n("Warning: Blender couldn't attach the shared memory, frames are sent via the socket"))
+                    self.signals.connected.emit(True, init)
+                    writer = threading.Thread(target=self.sendLoop, args=(conn,), daemon=True)
+                    writer.start()
+                    selector = selectors.DefaultSelector()
+                    selector.register(conn, selectors.EVENT_READ)
                     while self.running:
                         if l == None or l == 0:
                             l = d.nodeByName(self.settings.layerName)
@@ -141,10 +562,19 @@ class BlenderLayerServer(QRunnable):
                             raise Exception(i18n("Error: Layer not found"))
                             
                         if d.width() != width or d.height() != height:
-                            if d.width() > orgWidth or d.height() > orgHeight and shm:
-                                self.signals.error.emit(i18n("Warning: Disabling shared memory since image size changed. Consider Reconnecting"))
                             width = d.width()
                             height = d.height()
+                            if ring and width > 0 and height > 0 and bytesPerPixel * width * height > ring.dataSize:
+                                # Grow the segment under a new name, Blender remaps it and acknowledges with 'sharedMemAttached'
+                                try:
+                                    newRing = SharedFrameRing(f'krita_blender_layer:{PORT}:{ring.generation + 1}', bytesPerPixel * width * height, ring.generation + 1)
+                                    if oldRing:
+                                        oldRing.close()
+                                    oldRing = ring
+                                    ring = newRing
+                                    self.sendMessage(('sharedMem', ring.name, ring.generation))
+                                except Exception as e:
+                                    self.signals.error.emit(i18n("Warning: Failed to resize shared memory: {0}").format(str(e)))
                             if not width or not height or width <= 0 or height <= 0:
                                 self.running = False
                                 break
@@ -155,10 +585,34 @@ class BlenderLayerServer(QRunnable):
                                     self.settings.regionHeight = height
                                     self.sendMessage(('region', self.settings.regionX, self.settings.regionY, self.settings.regionWidth, self.settings.regionHeight, self.settings.regionViewport))
 
-                        msgs = recvObj(conn)
+                        # Sleep until Blender sends something, only waking up to release the lock and notice a resized document
+                        if not selector.select(IDLE_UNLOCK_DELAY if locked else RESIZE_CHECK_INTERVAL):
+                            if locked:
+                                d.unlock()
+                                if refresh:
+                                    self.signals.refresh.emit();
+                                    refresh = False
+                                locked = False
+                                framesLocked = 0
+                            continue
+
+                        msgs = recvMsgs(conn, framePool, decodePool)
+                        if msgs is None:
+                            break
+                        acked = [msg[7] for msg in msgs if msg[0] in FRAME_TYPES]
+                        if msgs and ring:
+                            # Only shared memory frames from the newest full one on are worth reading, older slots may already be reused
+                            newest = max([i for i, msg in enumerate(msgs) if (msg[0] == 'update' or msg[0] == 'updateTrimmed') and msg[5] is None], default = -1)
+                            msgs = [msg for i, msg in enumerate(msgs) if i >= newest or (msg[0] != 'update' and msg[0] != 'updateTile' and msg[0] != 'updateTrimmed') or msg[5] is not None]
                         if msgs:
                             for msg in msgs:
-                                if msg[0] == 'update' or msg[0] == 'updateFrame' or msg[0] == 'updateFrameFromFile' or msg[0] == 'updateFromFile' or msg[0] == 'clear':
+                                if msg[0] == 'updateTile' and (appliedSequence == None or (msg[7] != appliedSequence and msg[7] != (appliedSequence + 1) & 0xffffffff)):
+                                    # Tiles are relative to the previous frame, which Krita didn't fully receive
+                                    if keyframeRequested != msg[7]:
+                                        keyframeRequested = msg[7]
+                                        self.sendMessage(('requestKeyframe', True))
+                                    continue
+                                if msg[0] == 'update' or msg[0] == 'updateFrame' or msg[0] == 'updateTile' or msg[0] == 'updateTrimmed' or msg[0] == 'updateFrameFromFile' or msg[0] == 'updateFromFile' or msg[0] == 'clear':
                                     if msg[0] == 'updateFrameFromFile' or msg[0] == 'updateFrame':
                                         t = msg[6] if msg[0] == 'updateFrame' else msg[4]
                                         if locked:
@@ -182,18 +636,58 @@ class BlenderLayerServer(QRunnable):
                                                 break
                                             time.sleep(0.01)
                                     if locked or self.settings.lockFrames == 0:
-                                        if msg[0] == 'update' or msg[0] == 'updateFrame':
+                                        if msg[0] == 'update' or msg[0] == 'updateFrame' or msg[0] == 'updateTile' or msg[0] == 'updateTrimmed':
                                             x = msg[1]
                                             y = msg[2]
                                             w = msg[3]
                                             h = msg[4]
+                                            frameRects = [(x, y, w, h)] if msg[5] is not None else [(rx, ry, rw, rh) for (rx, ry, rw, rh, offset) in msg[10]]
                                             if msg[0] == 'updateFrame':
                                                 if x > 0 or y > 0 or w < d.width() or h < d.height():
                                                     l.setPixelData(QByteArray(bytes(d.width() * d.height() * 4)), 0, 0, d.width(), d.height())
-                                            if msg[5]:
-                                                l.setPixelData(QByteArray(msg[5]), x, y, w, h)
-                                            elif shm:
-                                                l.setPixelData(QByteArray(shm.buf.tobytes()), x, y, w, h)
+                                                covered = (0, 0, d.width(), d.height())
+                                            elif msg[0] == 'updateTrimmed':
+                                                # Only the opaque box was sent, whatever an earlier frame left around it inside the region is transparent now
+                                                region = (self.settings.regionX, self.settings.regionY, self.settings.regionWidth, self.settings.regionHeight)
+                                                if self.settings.canvasView:
+                                                    # Blender only renders the visible part, whatever lies outside of it stays
+                                                    region = intersectRect(region, self.settings.canvasView[:4]) or region
+                                                box = unionRect(*frameRects)
+                                                for (cx, cy, cw, ch) in subtractRect(intersectRect(covered, region), box):
+                                                    l.setPixelData(QByteArray.fromRawData(zeroPool.get(0, cw * ch * bytesPerPixel)), cx, cy, cw, ch)
+                                                covered = box if covered == intersectRect(covered, region) else unionRect(covered, box)
+                                            else:
+                                                covered = unionRect(covered, *frameRects)
+                                            frameFormat = msg[8] if msg[5] is not None else msg[12]
+                                            if frameFormat != format and (frameFormat != 'RGBA8' or 'rgba8Frames' not in features):
+                                                appliedSequence = None
+                                                self.signals.error.emit(i18n("Warning: Ignoring frame with format {0}, expected {1}").format(frameFormat, format))
+                                            elif msg[5] is not None:
+                                                self.writePixels(l, msg[5], x, y, w, h, msg[9], frameFormat, format)
+                                                appliedSequence = msg[7]
+                                            elif ring:
+                                                rects = msg[10]
+                                                scale = msg[11]
+                                                frameBytesPerPixel = FORMAT_SIZES[FORMATS.index(frameFormat)]
+                                                frameRing = ring if msg[9] == ring.generation else oldRing
+                                                size = max((offset + (rw // scale) * (rh // scale) * frameBytesPerPixel for (rx, ry, rw, rh, offset) in rects), default = 0)
+                                                data = frameRing.beginRead(msg[8], msg[7], size) if frameRing and frameRing.generation == msg[9] else None
+                                                torn = True
+                                                if data is None and frameRing and frameRing.generation == msg[9] and frameRing.superseded(msg[8], msg[7]):
+                                                    # A later frame took the slot and is on its way, tiles relative to this one can't be applied
+                                                    appliedSequence = None
+                                                    continue
+                                                if data is not None:
+                                                    for (rx, ry, rw, rh, offset) in rects:
+                                                        self.writePixels(l, data[offset:offset + (rw // scale) * (rh // scale) * frameBytesPerPixel], rx, ry, rw, rh, scale, frameFormat, format)
+                                                    data.release()
+                                                    torn = not frameRing.endRead(msg[8])
+                                                if torn:
+                                                    appliedSequence = None
+                                                    self.signals.error.emit(i18n("Warning: Shared memory frame was incomplete, requesting a new one"))
+                                                    self.sendMessage(('requestKeyframe', True))
+                                                else:
+                                                    appliedSequence = msg[7]
                                             
                                             if locked:
                                                 refresh = True
@@ -202,6 +696,7 @@ class BlenderLayerServer(QRunnable):
                                             if modifiedSupported:
                                                 d.setModified(True)
                                         elif msg[0] == 'updateFromFile' or msg[0] == 'updateFrameFromFile':
+                                            covered = (0, 0, d.width(), d.height())
                                             frame = QImage(msg[3])
                                             if format == 'RGBA8':
                                                 frame = frame.convertToFormat(QImage.Format_RGBA8888)
@@ -240,9 +735,20 @@ class BlenderLayerServer(QRunnable):
                                                 d.setModified(True)
                                         else:
                                             l.setPixelData(QByteArray(bytes(d.width() * d.height() * 4)), 0, 0, d.width(), d.height())
+                                            covered = None
 
-                                    elif self.settings.updateMode > 0:
-                                        self.signals.error.emit(i18n("Warning: Failed to acquire lock. Dropping a frame"))
+                                    else:
+                                        appliedSequence = None
+                                        if self.settings.updateMode > 0:
+                                            self.signals.error.emit(i18n("Warning: Failed to acquire lock. Dropping a frame"))
+                                        if msg[0] in FRAME_TYPES and keyframeRequested != msg[7]:
+                                            # Blender skips frames identical to the ones it sent, so it has to know this one never arrived
+                                            keyframeRequested = msg[7]
+                                            self.sendMessage(('requestKeyframe', True))
+                                elif msg[0] == 'sharedMemAttached':
+                                    if oldRing and ring and msg[1] == ring.generation:
+                                        oldRing.close()
+                                        oldRing = None
                                 elif msg[0] == 'updateAnimation':
                                     start = msg[3]
                                     end = msg[4]
@@ -296,8 +802,6 @@ class BlenderLayerServer(QRunnable):
                                                     d.setCurrentTime(t)
                                                     instance.action('remove_frames').trigger() 
                                                 time.sleep(0.01)
-                                            if self.running:
-                                                sendObj(conn, 'wait')
 
                                     d.waitForDone()
                                     l.setLocked(True)
@@ -305,6 +809,10 @@ class BlenderLayerServer(QRunnable):
                                     self.signals.msgReceived.emit(msg)
                              
                             
+                        if acked:
+                            # Hands Blender's frame scheduler a credit back, dropped frames count as consumed too
+                            self.sendMessage(('ack', acked[-1]))
+
                         if locked:
                             framesLocked = framesLocked + 1
                             if framesLocked >= self.settings.lockFrames:
@@ -315,28 +823,16 @@ class BlenderLayerServer(QRunnable):
                                     refresh = False
                                 locked = False
                                 framesLocked = 0
-                                
-                        msgs = []
-                        lastType = None
-                        while not self.sendQueue.empty():
-                            msg = self.sendQueue.get()
-                            type = msg[0]
-                            if type == lastType and type != 'append':
-                                if type == 'zoom':
-                                    msg = (type, msg[1] + msgs[-1][1])
-                                elif type == 'pan':
-                                    msg = (type, msg[1] + msgs[-1][1], msg[2] + msgs[-1][2])
-                                elif type == 'posePreviews':
-                                    msg[1].extend(msgs[-1][1])
-                                msgs[-1] = msg
-                            else:
-                                msgs.append(msg)
-                            lastType = type
-                                                            
-                        if self.running:
-                            sendObj(conn, msgs)
 
+                    self.connection = None
+                    self.sendQueue.wake()
+                    selector.close()
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
                     conn.close()
+                    writer.join()
                 except socket.timeout:
                     pass
                 l.setLocked(False)
@@ -364,13 +860,16 @@ class BlenderLayerServer(QRunnable):
         try:
             if s:
                 s.close()
+            if unixPath:
+                os.unlink(unixPath)
         except Exception as e:
             print(e)
             
         try:
-            if shm:
-                shm.close()
-                shm.unlink()
+            if ring:
+                ring.close()
+            if oldRing:
+                oldRing.close()
         except Exception as e:
             print(e)
         